@@ -16,9 +16,12 @@ setuptools.setup(
                 'sizes with specified contents.',
     long_description=open('README.md').read(),
     keywords=['testing', 'files', 'size'],
+    python_requires='>=3.4',
     install_requires=[
         "fusepy==2.0.4",
-        "docopt==0.6.2",
         "fs==0.5.4"
     ],
+    extras_require={
+        "cli": ["docopt==0.6.2"],
+    },
 )
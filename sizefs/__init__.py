@@ -8,5 +8,5 @@ __all__ = ['SizeFS', 'SizeFSZeroGen']
 from .sizefs import SizeFS
 from .contents import (  # noqa
     SizeFSAlphaNumGen, SizeFSZeroGen, SizeFSOneGen, SizeFSGeneratorType,
-    ONE_K, FastRandom, FILE_REGEX
+    ONE_K, FastRandom, FILE_REGEX, parse_filename, file_size
 )
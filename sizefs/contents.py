@@ -6,76 +6,224 @@ Content Generation Code for SizeFS
 
 __author__ = "Joel Wright, Mark McArdle"
 
+import os
 import re
+import bisect
 import random
 import logging
+import threading
 
+from functools import lru_cache
 from string import ascii_uppercase, ascii_lowercase, digits
+from types import MappingProxyType
 
 ONE_K = 1000
 
 FILE_REGEX = re.compile(
-    "^(?P<size>[0-9]+(\.[0-9])?)(?P<size_si>[EPTGMKB])((?P<operator>[\+|\-])"
+    "^(?P<size>[0-9]+(\.[0-9])?)(?P<size_si>[EPTGMKB])((?P<operator>[\+\-])"
     "(?P<shift>\d+)""(?P<shift_si>[EPTGMKB]))?$"
 )
 
 
-class SizeFSGeneratorType(object):
+SI_UNITS = "EPTGMKB"
+UNIT_SIZES = dict((unit, ONE_K ** power)
+                  for (power, unit) in enumerate(reversed(SI_UNITS)))
+
+
+# FILE_REGEX without its quirks: the whole name has to match, so there is no
+# trailing newline allowed by $, and shifts are [0-9] rather than any \d
+_FILENAME_REGEX = re.compile(
+    r"(?P<size>[0-9]+(?:\.[0-9])?)(?P<size_si>[EPTGMKB])"
+    r"(?:(?P<operator>[+\-])(?P<shift>[0-9]+)(?P<shift_si>[EPTGMKB]))?"
+)
+
+
+@lru_cache(maxsize=4096)
+def parse_filename(name):
+    """
+    Split a filename such as 4M, 1.5G or 4M-1B into the groups of FILE_REGEX,
+    returning None if it isn't a valid size.
+
+    The same few names are looked up over and over, so results are cached,
+    and returned read-only as they are shared between callers. A miss is a
+    single fullmatch, the regex engine walks the name quicker than Python
+    code picking it apart by hand.
+    """
+    match = _FILENAME_REGEX.fullmatch(name)
+    if match is None:
+        return None
+    return MappingProxyType(match.groupdict())
+
+
+def file_size(groups):
+    """
+    Return the size in bytes described by the groups of a parsed filename,
+    e.g. 3999999 for 4M-1B. Shifts below zero give an empty file.
+    """
+    unit = UNIT_SIZES[groups["size_si"]]
+    # Sizes have at most one decimal place, which integer maths handles
+    # exactly where a float loses precision on the largest units
+    size = groups["size"]
+    if '.' in size:
+        # Count in tenths, e.g. 1.5K is 15 * 1000 // 10
+        size = int(size.replace('.', '')) * unit // 10
+    else:
+        size = int(size) * unit
+    operator = groups["operator"]
+    if operator is None:
+        return size
+    shift = int(groups["shift"]) * UNIT_SIZES[groups["shift_si"]]
+    if operator == '-':
+        return max(0, size - shift)
+    return size + shift
+
+
+# Patterns containing none of the Xeger special characters are plain strings
+_LITERAL_REGEX = re.compile(r'^[^\\\[\]{}*+?()]*$')
+
+
+def _to_bytes(text):
+    """
+    Encode pattern text as UTF-8, leaving anything already bytes untouched
+    """
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def _extend_cyclic(content, data, start, count):
+    """
+    Append count bytes of data to content, starting at offset start and
+    wrapping around to the beginning of data as often as necessary
+    """
+    start %= len(data)
+    repeats, remainder = divmod(start + count, len(data))
+    if repeats:
+        content += data[start:]
+        if isinstance(data, bytes):
+            content += data * (repeats - 1)
+        else:
+            # memoryviews can't be multiplied, but they are only ever large
+            # filler blocks so there are few repeats
+            for _ in range(repeats - 1):
+                content += data
+        content += data[:remainder]
+    else:
+        content += data[start:remainder]
+
+
+def _last_end(ends, limit):
+    """
+    Return the largest of the sorted offsets in ends that is no greater than
+    limit, or 0 if there is none
+    """
+    index = bisect.bisect_right(ends, limit)
+    return ends[index - 1] if index else 0
+
+
+class SizeFSGeneratorType:
     ZEROS = 'zeros'
     ONES = 'ones'
     ALPHA_NUM = 'alpha_num'
     REGEX = 'regex'
 
 
-class SizeFSGen(object):
+class SizeFSGen:
     """
     Generate Zeros
+
+    Content repeats every len(chars) bytes, and FUSE reads in blocks of a
+    fixed size, so reads that are aligned the same way within chars get the
+    same content. The last read is kept and handed out again to the next
+    read with the same alignment and length.
     """
+    # Longest result worth keeping, FUSE reads are 128KiB by default
+    MAX_CACHED = 1024 * 1024
 
     def __init__(self):
-        self.chars = 'X'
+        self.chars = b'X'
+        self._last = (None, b'')
 
-    def fill(self, fill):
-        if len(self.chars) == 0:
-            return self.chars * fill
-        else:
-            pre_seed_count = 0
-            content = []
-            pre_seed_len = len(self.chars)
-            while fill > pre_seed_len:
-                content.append(self.chars)
-                fill -= pre_seed_len
-                pre_seed_count += 1
-            content.append(self.chars[0:fill])
-            return ''.join(content)
+    def fill(self, fill, offset=0):
+        """
+        Return 'fill' bytes of content, repeating self.chars as needed and
+        starting 'offset' bytes into the repeating content
+        """
+        chars = self.chars
+        offset %= len(chars)
+        if offset + fill <= len(chars):
+            # Within one run of chars, no need to rotate them
+            return chars[offset:offset + fill]
+        if offset:
+            chars = chars[offset:] + chars[:offset]
+        repeats, remainder = divmod(fill, len(chars))
+        return chars * repeats + chars[:remainder]
 
     def read(self, start, end):
-        if start <= end:
-            return self.chars * (end-start)
-        else:
-            return ''
-
-
-class SizeFSZeroGen(SizeFSGen):
+        """
+        Return the content from start to end inclusive, as XegerGen does
+        """
+        length = end - start + 1
+        if length <= 0:
+            return b''
+        key = (start % len(self.chars), length)
+        # Swapped as one tuple so threads always see a matching pair
+        (last_key, last) = self._last
+        if key == last_key:
+            return last
+        content = self.fill(length, key[0])
+        if length <= self.MAX_CACHED:
+            self._last = (key, content)
+        return content
+
+
+class SizeFSCharGen(SizeFSGen):
     """
-    Generate Zeros
+    Generate a single repeated character
+
+    Every offset holds the same byte, so fills skip the offset handling and
+    go straight to one multiplication.
     """
-    CHARS = '0'
+    CHARS = b'X'
 
     def __init__(self):
-        super(SizeFSZeroGen, self).__init__()
+        super().__init__()
         self.chars = self.CHARS
 
+    def fill(self, fill, offset=0):
+        """
+        Return 'fill' bytes of content, which is the same at any offset
+        """
+        return self.chars * fill
+
 
-class SizeFSOneGen(SizeFSGen):
+class SizeFSZeroGen(SizeFSCharGen):
+    """
+    Generate Zeros
+
+    These are ASCII '0' characters rather than NUL bytes, the contents of
+    the zeros folder are meant to be readable.
+    """
+    CHARS = b'0'
+
+
+class SizeFSOneGen(SizeFSCharGen):
     """
     Generate Ones
     """
-    CHARS = '1'
+    CHARS = b'1'
 
-    def __init__(self):
-        super(SizeFSOneGen, self).__init__()
-        self.chars = self.CHARS
+
+@lru_cache(maxsize=None)
+def _translation_table(chars):
+    """
+    Return a table mapping every byte value onto chars, and the byte values
+    to delete so that each of chars is equally likely
+    """
+    usable = 256 - 256 % len(chars)
+    table = bytes(chars[i % len(chars)] for i in range(256))
+    delete = bytes(range(usable, 256))
+    return table, delete
 
 
 class SizeFSAlphaNumGen(SizeFSGen):
@@ -83,22 +231,29 @@ class SizeFSAlphaNumGen(SizeFSGen):
     Generate Alpha Numeric Characters
     """
     NUM_CHARS = 64 * 1024
-    CHARS = ascii_uppercase + digits + ascii_lowercase
+    CHARS = (ascii_uppercase + digits + ascii_lowercase).encode('ascii')
 
     def __init__(self):
-        super(SizeFSAlphaNumGen, self).__init__()
-        self.chars = ''.join(random.choice(
-            self.CHARS) for _ in range(self.NUM_CHARS)
-        )
+        super().__init__()
+        self.chars = self._random_chars(self.NUM_CHARS)
 
-    def read(self, start, end):
-        if start <= end:
-            return self.fill(end - start)
-        else:
-            return ''
+    def _random_chars(self, count):
+        """
+        Map bytes from os.urandom() onto CHARS with a translation table.
+
+        Random bytes beyond the last whole multiple of len(CHARS) would bias
+        the mapping, so they are deleted and replaced with fresh ones.
+        """
+        table, delete = _translation_table(self.CHARS)
+
+        content = bytearray()
+        while len(content) < count:
+            content += os.urandom(count - len(content)).translate(table,
+                                                                  delete)
+        return bytes(content)
 
 
-class FastRandom(object):
+class FastRandom:
     """
     random itself is too slow for our purposes, so we use random to populate
     a small list of randomly generated numbers that can be used in each call
@@ -109,18 +264,19 @@ class FastRandom(object):
 
     This is faster and good enough for a "random" filler
     """
-    def __init__(self, min, max, len=255):
-        # Generate a small list of random numbers
+    def __init__(self, min, max, len=256):
+        # Generate a small list of random numbers. len must be a power of two
+        # so that the index can wrap with a mask instead of a comparison
+        if len & (len - 1):
+            raise ValueError("FastRandom length must be a power of two")
         self.randoms = [random.randint(min, max) for i in range(len)]
         self.index = 0
         self.len = len
+        self._mask = len - 1
 
     def rand(self):
         value = self.randoms[self.index]
-        if self.index < self.len - 1:
-            self.index += 1
-        else:
-            self.index = 0
+        self.index = (self.index + 1) & self._mask
         return value
 
 
@@ -135,7 +291,7 @@ class XegerError(Exception):
         return repr(self.value)
 
 
-class XegerGen(object):
+class XegerGen:
     """
     The generator uses up to 4 regular expressions to generate the contents
     of a file defined below:
@@ -184,20 +340,21 @@ class XegerGen(object):
     remaining.
 
     max_random is used to define the largest random repeat factor of any
-    + or * operators.
-
-    Random seeks within a file may produce inconsistent results for general
-    file contents, however prefix and suffix will always be consistent with
-    the requested pattern.
+    + or * operators. A + always repeats at least once, so a max_random
+    below 1 leaves it repeating exactly once.
+
+    The body of the file repeats a block of whole filler patterns of just
+    over FILLER_BLOCK_SIZE bytes (or is cut short to fit a smaller file).
+    Random seeks within a file are therefore consistent with sequential
+    reads. Each file draws its own patterns, so files sharing a pattern
+    still differ, and they are only generated as far as reads reach.
     """
     reserved_chars = ['[', ']', '{', '}', '*', '+', '?']
+    FILLER_BLOCK_SIZE = 1024 * 1024
 
     def __init__(self, size, filler=None, prefix=None,
                  suffix=None, padder=None, max_random=10):
         self._size = size
-        self._end_last_read = 0
-        self._remainder = ""
-        self._remainder_length = 0
 
         if filler == "":
             logging.error("Empty filler pattern supplied,"
@@ -217,51 +374,52 @@ class XegerGen(object):
             suffix = None
 
         if filler is not None:
-            self._filler = Xeger(filler, max_random)
+            self._filler = _xeger_factory(filler, max_random)
         else:
-            self._filler = Xeger("0", max_random)
+            self._filler = _xeger_factory("0", max_random)
 
         if padder is not None:
-            self._padder = Xeger(padder, max_random)
+            self._padder = _xeger_factory(padder, max_random)
         else:
-            self._padder = Xeger("0", max_random)
+            self._padder = _xeger_factory("0", max_random)
 
         if prefix is not None:
-            prefix_c = []
-            _, prefix_len = Xeger(prefix, max_random).generate(prefix_c, 0)
-            self._prefix = "".join(prefix_c)
-            self._prefix_length = prefix_len
+            self._prefix = self._materialize(prefix, max_random)
         else:
-            self._prefix = ""
-            self._prefix_length = 0
+            self._prefix = b""
+        self._prefix_length = len(self._prefix)
 
         if suffix is not None:
-            suffix_c = []
-            _, suffix_len = Xeger(suffix, max_random).generate(suffix_c, 0)
-            self._suffix = "".join(suffix_c)
-            self._suffix_length = suffix_len
+            self._suffix = self._materialize(suffix, max_random)
         else:
-            self._suffix = ""
-            self._suffix_length = 0
+            self._suffix = b""
+        self._suffix_length = len(self._suffix)
 
         if size < (self._prefix_length + self._suffix_length):
             logging.error("Prefix and suffix combination is longer than"
                           "the requested size of the file. One or both will"
                           "be truncated")
 
-        self._get_filler = self._filler.generate
+        # Lay out the regions of the file once, where the filler ends and
+        # the padding starts is only worked out when a read needs it
+        self._head_length = min(self._prefix_length, size)
+        tail_length = min(self._suffix_length, size - self._head_length)
+        self._body_length = size - self._head_length - tail_length
+        # The regions are kept as memoryviews so that reads slice them
+        # without an intermediate copy
+        self._head = memoryview(self._prefix)[:self._head_length]
+        self._tail = memoryview(self._suffix)[
+            self._suffix_length - tail_length:]
+        self._stream = _FillerStream(self._filler, self._padder)
+        self._layout = None
 
     def read(self, start, end):
         """
         Return regex content.
 
-        Only fully supports sequential reading, however, any read with start or
-        end range within a specified prefix or suffix pattern will produce
-        appropriate output (this is necessary for metadata testing functions).
+        The body of the file is a repeating block of filler, so reads may
+        start at any offset and always agree with each other.
         """
-        content = []
-        content_length = 0
-
         if end > self._size - 1:
             logging.debug("Read beyond end of generator requested - resetting"
                           "requested end to size of generator")
@@ -271,79 +429,91 @@ class XegerGen(object):
             logging.error("Can't read before the beginning")
             start = 0
 
-        self._end_last_read = end
-
-        if start < self._prefix_length:
-            self._remainder = ""
-            self._remainder_length = 0
-            content.append(self._prefix[start:])
-            content_length += self._prefix_length - start
-        else:
-            if start == self._end_last_read + 1:
-                # If we're reading sequentially, append any remainder
-                content.append(self._remainder)
-                content_length += self._remainder_length
-                self._remainder = ""
-                self._remainder_length = 0
-
-        chunk_size = (end + 1) - start
-
-        # Calculate how much content is required
-        last_required = False
-        if end > (self._size - self._suffix_length):
-            # If we're sufficiently close to the end size of the contents
-            # requested, then we need to consider padding and suffix
-            last_required = True
-            last = self._suffix[
-                :self._suffix_length + (end - (self._size - 1))
-            ]
-            still_required = chunk_size - len(last)
-        else:
-            still_required = chunk_size
-
-        # Grab content
-        while content_length < still_required:
-            new_items, content_length = \
-                self._get_filler(content, content_length)
-
-        # Adjust content and get padding if necessary
-        if content_length > still_required:
-            overrun = content_length - still_required
-            overrun_content = []
-            for x in range(new_items):
-                overrun_content.insert(0, content.pop())
-            overrun_content_string = "".join(overrun_content)
-            overrun_length = len(overrun_content_string)
-            if (end + overrun) > (self._size - 1 - self._suffix_length):
-                content_length -= overrun_length
-                padding_required = still_required - content_length
-                pad, pad_length = self._get_padding(padding_required)
-                content.append(pad)
-                if last_required:
-                    content.append(last)
-            else:
-                this_time = overrun_length - overrun
-                content.append(overrun_content_string[:this_time])
-                self._remainder = overrun_content_string[this_time:]
-                self._remainder_length = len(self._remainder)
-        elif content_length == still_required:
-            if last_required:
-                content.append(last)
+        if start > end:
+            return b""
+
+        stop = end + 1
+        body_start = start - self._head_length
+        body_stop = stop - self._head_length
+        limit = min(self._body_length, self.FILLER_BLOCK_SIZE)
+
+        # Most reads fall within the first run of the filler block, which is
+        # the start of the stream and only needs generating that far
+        if body_start >= 0 and body_stop <= limit:
+            data, ends = self._stream.extend_to(body_stop, limit)
+            if body_stop <= _last_end(ends, limit):
+                return data[body_start:body_stop]
+
+        block, fill_length, padding = self._layout or self._lay_out()
+
+        # Later runs of the block can be copied out in one go as well
+        if body_start >= 0 and body_stop <= fill_length:
+            block_start = body_start % len(block)
+            block_stop = block_start + stop - start
+            if block_stop <= len(block):
+                return block[block_start:block_stop].tobytes()
+
+        content = bytearray()
+        regions = (
+            (self._head, self._head_length),
+            (None, fill_length),
+            (padding, len(padding)),
+            (self._tail, len(self._tail)),
+        )
+        offset = 0
+        for data, length in regions:
+            region_start = max(start - offset, 0)
+            region_stop = min(stop - offset, length)
+            if region_start < region_stop:
+                if data is None:
+                    _extend_cyclic(content, block, region_start,
+                                   region_stop - region_start)
+                else:
+                    content += data[region_start:region_stop]
+            offset += length
 
-        return "".join(content)
+        return bytes(content)
 
-    def _get_padding(self, size):
-        pad = []
-        pad_length = 0
+    def _lay_out(self):
+        """
+        Work out the filler block that repeats through the body and how much
+        of the body whole patterns fill, leaving the rest to padding.
 
-        while pad_length < size:
-            new_items, pad_length = \
-                self._padder.generate(pad, pad_length)
+        Everything comes from the file's stream, so racing readers work out
+        the same layout and it doesn't matter which of them is kept.
+        """
+        body_length = self._body_length
+        limit = min(body_length, self.FILLER_BLOCK_SIZE)
+        data, ends = self._stream.extend_to(limit, limit)
+        if body_length <= limit:
+            block_length = body_length
+            fill_length = _last_end(ends, body_length)
+        else:
+            # The block runs to the end of the pattern that crosses the limit
+            block_length = ends[bisect.bisect_left(ends, limit)]
+            whole, partial = divmod(body_length, block_length)
+            fill_length = whole * block_length + _last_end(ends, partial)
+
+        padding = self._stream.padding(body_length - fill_length)
+        self._layout = (memoryview(data)[:block_length], fill_length,
+                        memoryview(padding))
+        return self._layout
+
+    @staticmethod
+    def _materialize(pattern, max_random):
+        """
+        Generate a fixed pattern (prefix or suffix) once.
 
-        return "".join(pad)[:size], size
+        Plain strings are used as they are, without building a parser.
+        """
+        if _LITERAL_REGEX.match(pattern):
+            return _to_bytes(pattern)
+        content = bytearray()
+        _xeger_factory(pattern, max_random).generate(content)
+        return bytes(content)
 
 
-class Xeger(object):
+class Xeger:
     """
     Parses a given regex pattern and yields content on demand.
 
@@ -356,25 +526,221 @@ class Xeger(object):
         if self._pattern.length() == 1:
             self._pattern = self._pattern._expressions[0]
 
-        self.generate = self._pattern.generate
+        self._const_bytes = None
+        if self._pattern.is_constant:
+            # The pattern always produces the same output, so generate it
+            # once and skip walking the parse tree on every call
+            constant = bytearray()
+            self._pattern.generate(constant)
+            self._const_bytes = bytes(constant)
+            self.generate = self._generate_constant
+        elif isinstance(self._pattern, XegerSet):
+            self.generate = self._pattern.generate
+        else:
+            self.generate = _compile_generator(self._pattern)
+
+    @property
+    def constant_bytes(self):
+        """
+        The bytes generated every time for a pattern with no random parts,
+        or None if the output varies
+        """
+        return self._const_bytes
+
+    def _generate_constant(self, generated_content):
+        generated_content += self._const_bytes
+
+
+class _SourceWriter:
+    """
+    Collects the source of a generated generate() function, along with the
+    objects it refers to
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = {}
+
+    def bind(self, value):
+        """
+        Make value available to the generated code, returning its name
+        """
+        name = "_v%d" % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def line(self, indent, text):
+        self.lines.append("    " * indent + text)
+
+    def emit(self, node, indent):
+        """
+        Write the code for a parse tree node, inlining its output if it is
+        always the same
+        """
+        if node.is_constant:
+            content = bytearray()
+            node.generate(content)
+            if content:
+                self.line(indent, "buf += %s" % self.bind(bytes(content)))
+            else:
+                self.line(indent, "pass")
+        else:
+            node.compile_source(self, indent)
+
+    def source(self):
+        return "def generate(buf):\n%s\n" % "\n".join(self.lines)
+
+
+def _compile_generator(node):
+    """
+    Turn a parse tree into a single generate(buf) function
+
+    Walking the tree costs a method call per node per repeat. The compiled
+    function does the same work as straight-line code and loops, consuming
+    the node's random numbers in the same order.
+
+    Each random group becomes a nested loop, and Python only allows 20 of
+    them in one function, so deeper patterns keep walking the tree.
+    """
+    writer = _SourceWriter()
+    writer.emit(node, 1)
+    try:
+        exec(writer.source(), writer.namespace)
+    except SyntaxError:
+        return node.generate
+    return writer.namespace["generate"]
+
+
+XEGER_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=XEGER_CACHE_SIZE)
+def _xeger_factory(regex, max_random):
+    """
+    Return a shared Xeger for a pattern, parsing it only on first use.
+
+    A Xeger holds no per-file state between calls to generate() (the
+    FastRandom buffers it owns are fine to share) so one instance can serve
+    every XegerGen using the same pattern.
+    """
+    return Xeger(regex, max_random)
+
+
+class _FillerStream:
+    """
+    Whole filler patterns, and padding, generated once for a XegerGen
+
+    The stream only ever grows, doubling as reads reach further into it, so
+    a small read doesn't generate a whole filler block. Its data and the
+    offsets where each pattern ends are published together as one tuple, and
+    bytes already handed out never change.
+    """
+    __slots__ = ('_filler', '_padder', '_lock', '_state', '_padding')
+
+    def __init__(self, filler, padder):
+        self._filler = filler
+        self._padder = padder
+        self._lock = threading.Lock()
+        self._state = (b"", ())
+        self._padding = b""
+
+    def extend_to(self, length, limit):
+        """
+        Return (data, ends) with at least length bytes of whole patterns,
+        growing by doubling up to limit (or just past, to finish a pattern)
+        """
+        state = self._state
+        if len(state[0]) >= length:
+            return state
+        # FUSE serves reads from several threads, only one of them should
+        # generate each stretch of the stream
+        with self._lock:
+            data, ends = self._state
+            if len(data) >= length:
+                return self._state
+            target = max(length, min(2 * len(data), limit))
+            constant = self._filler.constant_bytes
+            if constant:
+                # Every pattern is the same, so tile them with one
+                # multiplication rather than generating them one at a time
+                step = len(constant)
+                data = constant * -(-target // step)
+                ends = range(step, len(data) + 1, step)
+            else:
+                block = bytearray(data)
+                ends = list(ends)
+                generate = self._filler.generate
+                while len(block) < target:
+                    generate(block)
+                    ends.append(len(block))
+                data = bytes(block)
+            self._state = (data, ends)
+            return self._state
+
+    def padding(self, size):
+        """
+        Return size bytes of padding
+        """
+        if len(self._padding) < size:
+            with self._lock:
+                pad = bytearray(self._padding)
+                while len(pad) < size:
+                    self._padder.generate(pad)
+                self._padding = bytes(pad)
+        return self._padding[:size]
 
 
-class XegerPattern(object):
+class _Cursor:
+    """
+    A position within a pattern being parsed
+
+    Parsers consume the pattern one character at a time with pop() and can
+    step back with pushback(), without copying or shifting the pattern.
+    """
+    __slots__ = ('text', 'pos')
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.text) - self.pos
+
+    def __str__(self):
+        return "".join(self.text[self.pos:])
+
+    def pop(self):
+        c = self.text[self.pos]
+        self.pos += 1
+        return c
+
+    def pushback(self):
+        self.pos -= 1
+
+
+class XegerPattern:
     """
     Parses a given pattern into a list of XegerExpressions
 
     This generates a list of top-level expressions that can be used to generate
     the contents of a file.
     """
+    __slots__ = ('_max_random', '_expressions', '_generators')
+
     def __init__(self, regex, max_random=10):
         self._max_random = max_random
         self._parse_expressions(regex)
+        # Bind each expression's generate() once rather than looking it up
+        # for every repetition of the pattern
+        self._generators = tuple(
+            expression.generate for expression in self._expressions
+        )
 
     def _parse_expressions(self, regex):
         self._expressions = []
-        regex_list = list(regex)
-        while regex_list:
-            expression = XegerExpression(regex_list, self._max_random)
+        cursor = _Cursor(regex)
+        while cursor:
+            expression = XegerExpression(cursor, self._max_random)
             if expression._multiplier is None:
                 self._expressions.append(expression._generator)
             else:
@@ -383,39 +749,48 @@ class XegerPattern(object):
     def length(self):
         return len(self._expressions)
 
-    def generate(self, generated_content, generated_content_length):
-        new_item_count = 0
+    @property
+    def is_constant(self):
+        return all(expression.is_constant
+                   for expression in self._expressions)
+
+    def generate(self, generated_content):
+        for generate in self._generators:
+            generate(generated_content)
+
+    def compile_source(self, writer, indent):
         for expression in self._expressions:
-            new_items, generated_content_length = \
-                expression.generate(generated_content,
-                                    generated_content_length)
-            new_item_count += new_items
-        return new_item_count, generated_content_length
+            writer.emit(expression, indent)
 
 
-class XegerExpression(object):
+class XegerExpression:
     """
-    Parses an Expression from a list of input characters
+    Parses an Expression from a _Cursor over the input characters
     """
-    def __init__(self, regex_list, max_random=10):
+    __slots__ = ('_max_random', '_generator', '_multiplier',
+                 '_constant_multiplier', '_is_set')
+
+    def __init__(self, regex, max_random=10):
         self._max_random = max_random
-        self._get_generator(regex_list)
+        self._get_generator(regex)
+        # Repeated sets can emit all their characters in one batch
+        self._is_set = isinstance(self._generator, XegerSet)
 
     def _get_generator(self, regex):
         accum = []
 
         while regex:
-            c = regex.pop(0)
+            c = regex.pop()
             # We've reached what appears to be a nested expression
             if c == '(':
                 if not accum:  # We've not accumulated any content to return
                     accum = self._get_nested_pattern_input(regex)
                     self._generator = XegerPattern(accum, self._max_random)
-                    self._multiplier = XegerMultiplier(regex)
+                    self._multiplier = XegerMultiplier(regex, self._max_random)
                     self._is_constant_multiplier()
                     return
                 else:  # There is info in the accumulator, so it much be chars
-                    regex.insert(0, c)
+                    regex.pushback()
                     self._generator = XegerSequence(accum)
                     self._constant_multiplier = None
                     self._multiplier = None
@@ -423,30 +798,31 @@ class XegerExpression(object):
             elif c == '[':  # We've reached the start of a set
                 if not accum:  # If nothing in accumulator, just process set
                     self._generator = XegerSet(regex)
-                    self._multiplier = XegerMultiplier(regex)
+                    self._multiplier = XegerMultiplier(regex, self._max_random)
                     self._is_constant_multiplier()
                     return
                 else:
                     # There's already stuff in the accumulator, must be chars
-                    regex.insert(0, c)
+                    regex.pushback()
                     self._generator = XegerSequence(accum)
                     self._constant_multiplier = None
                     self._multiplier = None
                     return
             elif c == '\\':  # Escape the next character
-                c = regex.pop(0)
+                c = regex.pop()
                 accum.append(c)
             elif c in ['{', '*', '+', '?']:  # We've reached a multiplier
                 if len(accum) == 1:  # just multiply a single character
-                    regex.insert(0, c)
+                    regex.pushback()
                     self._generator = XegerSequence(accum)
-                    self._multiplier = XegerMultiplier(regex)
+                    self._multiplier = XegerMultiplier(regex, self._max_random)
                     self._is_constant_multiplier()
                     return
                 elif len(accum) > 1:  # only multiply the last character
-                    last_c = accum.pop(-1)
-                    regex.insert(0, c)
-                    regex.insert(0, last_c)
+                    # Step back over the multiplier and the last character
+                    accum.pop(-1)
+                    regex.pushback()
+                    regex.pushback()
                     self._generator = XegerSequence(accum)
                     self._constant_multiplier = None
                     self._multiplier = None
@@ -473,48 +849,62 @@ class XegerExpression(object):
         else:
             self._constant_multiplier = False
 
+    @property
+    def is_constant(self):
+        return bool(self._constant_multiplier) and \
+            self._generator.is_constant
+
     def _get_nested_pattern_input(self, regex):
-        accum = []
+        start = regex.pos
+        depth = 0
 
         while regex:
-            c = regex.pop(0)
+            c = regex.pop()
             if c == '(':
-                accum.append('(')
-                accum += self._get_nested_pattern_input(regex)
-                accum.append(')')
+                depth += 1
             elif c == ')':
-                return accum
-            else:
-                accum.append(c)
+                if not depth:
+                    return regex.text[start:regex.pos - 1]
+                depth -= 1
 
         raise XegerError("Incomplete expression")
 
-    def generate(self, generated_content, generated_content_length):
+    def generate(self, generated_content):
         # self._multiplier & self._constant_multiplier
         # are guaranteed to be set if generate() is called
-        new_item_count = 0
         if self._constant_multiplier:
             mult = self._multiplier
-            for x in range(mult):
-                new_items, generated_content_length = \
-                    self._generator.generate(generated_content,
-                                             generated_content_length)
-                new_item_count += new_items
         else:
             mult = self._multiplier.value()
-            for x in range(mult):
-                new_items, generated_content_length = \
-                    self._generator.generate(generated_content,
-                                             generated_content_length)
-                new_item_count += new_items
 
-        return new_item_count, generated_content_length
+        if self._is_set:
+            self._generator.generate_n(generated_content, mult)
+            return
+
+        generate = self._generator.generate
+        for x in range(mult):
+            generate(generated_content)
+
+    def compile_source(self, writer, indent):
+        if self._constant_multiplier:
+            mult = str(self._multiplier)
+        else:
+            mult = "%s()" % writer.bind(self._multiplier.value)
+
+        if self._is_set:
+            writer.line(indent, "%s(buf, %s)" % (
+                writer.bind(self._generator.generate_n), mult))
+        else:
+            writer.line(indent, "for _ in range(%s):" % mult)
+            writer.emit(self._generator, indent + 1)
 
 
-class XegerMultiplier(object):
+class XegerMultiplier:
     """
     Represents a multiplier
     """
+    __slots__ = ('_max_random', 'is_random', '_constant', '_random')
+
     def __init__(self, regex, max_random=10):
         self._max_random = max_random
         self._get_multiplier(regex)
@@ -524,7 +914,7 @@ class XegerMultiplier(object):
         started = False
 
         while regex:
-            c = regex.pop(0)
+            c = regex.pop()
             if c == '{':
                 if mult:
                     raise XegerError("Error in multiplier pattern")
@@ -545,9 +935,11 @@ class XegerMultiplier(object):
                 else:
                     self.is_random = True
                     if c == '+':
-                        self._random = FastRandom(1, self._max_random)
+                        self._random = FastRandom(
+                            1, max(1, self._max_random))
                     elif c == '*':
-                        self._random = FastRandom(0, self._max_random)
+                        self._random = FastRandom(
+                            0, max(0, self._max_random))
                     else:
                         self._random = FastRandom(0, 1)
                     return
@@ -555,7 +947,7 @@ class XegerMultiplier(object):
                 if started:
                     mult.append(c)
                 else:
-                    regex.insert(0, c)
+                    regex.pushback()
                     break
 
         if started:
@@ -571,27 +963,35 @@ class XegerMultiplier(object):
             return self._constant
 
 
-class XegerSequence(object):
+class XegerSequence:
     """
     Simple generator, just returns the sequence on each call to generate
     """
+    __slots__ = ('_sequence',)
+
     def __init__(self, character_list):
-        self._sequence = "".join(character_list)
-        self._sequence_length = len(self._sequence)
+        self._sequence = _to_bytes("".join(character_list))
+
+    @property
+    def is_constant(self):
+        return True
 
-    def generate(self, generated_content, generated_content_length):
-        generated_content.append(self._sequence)
-        generated_content_length += self._sequence_length
-        return 1, generated_content_length
+    def generate(self, generated_content):
+        generated_content += self._sequence
 
 
-class XegerSet(object):
+class XegerSet:
     """
     Set generator, parses an input list for a set and returns a single element
     on each call to generate
+
+    Members are whole characters, each kept UTF-8 encoded so that a pick
+    never splits a multi-byte character.
     """
+    __slots__ = ('_set', '_random', '_picks')
+
     def __init__(self, regex):
-        logging.debug("Parsing Set from regex: %s" % "".join(regex))
+        logging.debug("Parsing Set from regex: %s", regex)
         self._parse_set(regex)
 
     def _parse_set(self, regex):
@@ -599,11 +999,19 @@ class XegerSet(object):
         ch1 = ''
 
         while regex:
-            c = regex.pop(0)
+            c = regex.pop()
             if c == ']':
                 if not ch1 == '':
-                    self._set = select_list
+                    self._set = tuple(select_list)
                     self._random = FastRandom(0, len(self._set) - 1)
+                    # The set member for each of the random indices, so
+                    # that runs of picks can be sliced out in one go when
+                    # every member is a single byte
+                    picks = tuple(self._set[i] for i in self._random.randoms)
+                    if all(len(member) == 1 for member in self._set):
+                        self._picks = b"".join(picks)
+                    else:
+                        self._picks = picks
                     return
                 else:
                     raise XegerError("Error in set description")
@@ -615,26 +1023,47 @@ class XegerSet(object):
                 else:
                     # Remove the unneeded character from the last loop
                     select_list.pop(-1)
-                    ch2 = regex.pop(0)
-                    set_extras = self._char_range(ch1, ch2)
-                    for extra in set_extras:
-                        select_list.append(extra)
+                    ch2 = regex.pop()
+                    select_list.extend(self._char_range(ch1, ch2))
             elif c == '\\':  # Escape the next character
-                c = regex.pop(0)
+                c = regex.pop()
                 ch1 = c
-                select_list.append(c)
+                select_list.append(_to_bytes(c))
             elif c in XegerGen.reserved_chars:
                 raise XegerError("Non-escaped special character in set")
             else:
                 ch1 = c
-                select_list.append(ch1)
+                select_list.append(_to_bytes(ch1))
 
         # The range was incomplete because we never reached the closing brace
         raise XegerError("Incomplete set description")
 
+    @property
+    def is_constant(self):
+        return False
+
     def _char_range(self, a, b):
-        return [chr(c) for c in range(ord(a), ord(b)+1)]
+        return [_to_bytes(chr(c)) for c in range(ord(a), ord(b) + 1)]
+
+    def generate(self, generated_content):
+        generated_content += self._set[self._random.rand()]
 
-    def generate(self, generated_content, generated_content_length):
-        generated_content.append(self._set[self._random.rand()])
-        return 1, generated_content_length + 1
+    def compile_source(self, writer, indent):
+        writer.line(indent, "buf += %s[%s()]" % (
+            writer.bind(self._set), writer.bind(self._random.rand)))
+
+    def generate_n(self, generated_content, count):
+        """
+        Equivalent to calling generate() count times, but takes the members
+        from the precomputed picks rather than choosing one per call
+        """
+        fast_random = self._random
+        start = fast_random.index
+        picks = self._picks
+        if isinstance(picks, bytes):
+            _extend_cyclic(generated_content, picks, start, count)
+        else:
+            length = fast_random.len
+            generated_content += b"".join(
+                picks[(start + i) % length] for i in range(count))
+        fast_random.index = (start + count) % fast_random.len
@@ -11,36 +11,36 @@ minus 1 byte
 
 >>> from sizefs import SizeFS
 >>> sfs = SizeFS()
->>> print len(sfs.open('1B').read())
+>>> print(len(sfs.open('1B').read()))
 1
->>> print len(sfs.open('2B').read())
+>>> print(len(sfs.open('2B').read()))
 2
->>> print len(sfs.open('1K').read())
+>>> print(len(sfs.open('1K').read()))
 1000
->>> print len(sfs.open('128K').read())
+>>> print(len(sfs.open('128K').read()))
 128000
 
 The folder structure can also be used to determine the content of the files
 
->>> print sfs.open('zeros/5B').read(5)
+>>> print(sfs.open('zeros/5B').read(5))
 00000
 
->>> print sfs.open('ones/128K').read(5)
+>>> print(sfs.open('ones/128K').read(5))
 11111
 
 File content can also be random
 
->>> print len(sfs.open('alpha_num/128K').read())
+>>> print(len(sfs.open('alpha_num/128K').read()))
 128000
->>> print len(sfs.open('alpha_num/128K-1B').read())
+>>> print(len(sfs.open('alpha_num/128K-1B').read()))
 127999
->>> print len(sfs.open('alpha_num/128K+1B').read())
+>>> print(len(sfs.open('alpha_num/128K+1B').read()))
 128001
 
 File content for common file size limits
 
->>> print sfs.listdir('common')
-[u'100M-1B', u'2G-1B', u'4G-1B', u'100M+1B', u'2G+1B', u'4G+1B']
+>>> print(sfs.listdir('common'))
+['100M-1B', '2G-1B', '4G-1B', '100M+1B', '2G+1B', '4G+1B']
 
 See
 https://code.google.com/p/macfuse/wiki/OPTIONS
@@ -59,71 +59,40 @@ import datetime
 import os
 import stat
 
-from docopt import docopt
+from functools import lru_cache
 from fs.path import iteratepath, pathsplit, normpath
 from fs.base import FS, synchronize
 from fs.errors import ResourceNotFoundError, ResourceInvalidError
 
 from .contents import (
-    SizeFSZeroGen, SizeFSOneGen, SizeFSAlphaNumGen, ONE_K, FILE_REGEX
+    SizeFSZeroGen, SizeFSOneGen, SizeFSAlphaNumGen, parse_filename, file_size
 )
-from .sizefsFuse import SizefsFuse
 
 __author__ = "Mark McArdle, Joel Wright"
 
-
-def __get_shift__(match):
-    """
-    Parses the shift part of a filename e.g. +128, -110
-    """
-    shift = 0
-    keys = match.groupdict().keys()
-    if "operator" in keys and "shift_si" in keys:
-        operator = match.group('operator')
-        shift_str = match.group('shift')
-        if operator != '' and shift_str:
-            shift = int(shift_str)
-            if operator == "-":
-                shift = -shift
-    return shift
+OPEN_CACHE_SIZE = 4096
 
 
 def __get_size__(filename):
     """
     Parses the filename to get the size of a file
-    e.g. 128M+12, 110M-10
+    e.g. 128M+1B, 110M-10K
     """
-    match = FILE_REGEX.search(filename)
-    if match:
-        size_str = match.group('size')
-        si_unit = match.group('size_si')
-        shift = __get_shift__(match)
-        mul = 1
-        if si_unit == 'B':
-            mul = 1
-        elif si_unit == 'K':
-            mul = ONE_K
-        elif si_unit == 'M':
-            mul = pow(ONE_K, 2)
-        elif si_unit == 'G':
-            mul = pow(ONE_K, 3)
-        elif si_unit == 'T':
-            mul = pow(ONE_K, 4)
-        size = int(size_str)
-        size_in_bytes = (size * mul) + shift
-        return size_in_bytes
+    groups = parse_filename(filename)
+    if groups:
+        return file_size(groups)
     else:
         raise ValueError
 
 
 def bytes_or_str(is_bytes, content):
-    if is_bytes:
-        return content.encode('utf-8')
-    else:
+    if is_bytes or isinstance(content, str):
         return content
+    else:
+        return content.decode('utf-8')
 
 
-class SizeFile(object):
+class SizeFile:
     """
     A mock file object that returns a specified number of bytes
     """
@@ -149,8 +118,9 @@ class SizeFile(object):
     def read(self, size=None):
         """ read size from the file, or if size is None read to end """
         if self.pos >= self.length or self.closed:
-            return bytes_or_str(self.is_bytes, '')
+            return bytes_or_str(self.is_bytes, b'')
 
+        start = self.pos
         if size is None:
             toread = self.tell()
             self.pos += toread
@@ -162,7 +132,8 @@ class SizeFile(object):
                 toread = size
                 self.pos = self.pos + size
 
-        return bytes_or_str(self.is_bytes, self.filler.fill(toread))
+        return bytes_or_str(self.is_bytes,
+                            self.filler.read(start, start + toread - 1))
 
     def seek(self, offset):
         """ seek the position by a distance of 'offset' bytes
@@ -186,7 +157,7 @@ class SizeFile(object):
         self.pos = 0
 
 
-class DirEntry(object):  # pylint: disable=R0902
+class DirEntry:  # pylint: disable=R0902
     """
     A directory entry. Can be a file or folder.
     """
@@ -246,7 +217,7 @@ class SizeFS(FS):  # pylint: disable=R0902,R0904,R0921
 
     def __init__(self, *args, **kwargs):
         self.verbose = kwargs.pop("verbose", False)
-        super(SizeFS, self).__init__(*args, **kwargs)
+        super().__init__(*args, **kwargs)
         self.sizes = [1, 10, 100]
         self.si_units = ['K', 'M', 'G', 'B']
         files = ["%s%s" % (size, si)
@@ -263,14 +234,15 @@ class SizeFS(FS):  # pylint: disable=R0902,R0904,R0921
         self.common = DirEntry(DirEntry.DIR_ENTRY, 'common',
                                filler=SizeFSZeroGen())
 
+        # Files share their folder's filler, the fillers don't depend on a
+        # file's name or size
         for filename in files:
             self.zeros.contents[filename] = DirEntry(
-                DirEntry.FILE_ENTRY, filename, filler=SizeFSZeroGen())
+                DirEntry.FILE_ENTRY, filename, filler=self.zeros.filler)
             self.ones.contents[filename] = DirEntry(
-                DirEntry.FILE_ENTRY, filename, filler=SizeFSOneGen())
+                DirEntry.FILE_ENTRY, filename, filler=self.ones.filler)
             self.alpha_num.contents[filename] = DirEntry(
-                DirEntry.FILE_ENTRY, filename,
-                filler=SizeFSAlphaNumGen())
+                DirEntry.FILE_ENTRY, filename, filler=self.alpha_num.filler)
 
         # Create a list of common file size limits
         common_sizes = [
@@ -284,15 +256,21 @@ class SizeFS(FS):  # pylint: disable=R0902,R0904,R0921
             plus_one = "%s+1B" % filename
             minus_one = "%s-1B" % filename
             self.common.contents[plus_one] = DirEntry(
-                DirEntry.FILE_ENTRY, plus_one, filler=SizeFSAlphaNumGen())
+                DirEntry.FILE_ENTRY, plus_one, filler=self.alpha_num.filler)
             self.common.contents[minus_one] = DirEntry(
-                DirEntry.FILE_ENTRY, minus_one, filler=SizeFSAlphaNumGen())
+                DirEntry.FILE_ENTRY, minus_one, filler=self.alpha_num.filler)
 
         self.root.contents['zeros'] = self.zeros
         self.root.contents['ones'] = self.ones
         self.root.contents['alpha_num'] = self.alpha_num
         self.root.contents['common'] = self.common
 
+        # Normalised path, parent DirEntry and file name for the paths most
+        # recently passed to open. The folder structure is fixed, so entries
+        # never go stale.
+        self._resolve_open_path = lru_cache(maxsize=OPEN_CACHE_SIZE)(
+            self._resolve_path)
+
     def _get_dir_entry(self, dir_path):
         """
         Returns a DirEntry for a specified path 'dir_path'
@@ -380,10 +358,10 @@ class SizeFS(FS):  # pylint: disable=R0902,R0904,R0921
 
         return info
 
-    @synchronize
-    def open(self, path, mode="r", **kwargs):
+    def _resolve_path(self, path):
         """
-
+        Return the normalised path, parent DirEntry and file name for a path
+        to open
         """
         path = normpath(path)
         file_path, file_name = pathsplit(path)
@@ -392,6 +370,15 @@ class SizeFS(FS):  # pylint: disable=R0902,R0904,R0921
         if parent_dir_entry is None or not parent_dir_entry.isdir():
             raise ResourceNotFoundError(path)
 
+        return path, parent_dir_entry, file_name
+
+    @synchronize
+    def open(self, path, mode="r", **kwargs):
+        """
+
+        """
+        path, parent_dir_entry, file_name = self._resolve_open_path(path)
+
         if 'r' in mode:
 
             if file_name in parent_dir_entry.contents:
@@ -428,6 +415,11 @@ def doc_test():
 
 
 if __name__ == '__main__':
+    from docopt import docopt
+    # fusepy loads libfuse as it is imported, which the pyfilesystem SizeFS
+    # doesn't need
+    from .sizefsFuse import SizefsFuse
+
     ARGUMENTS = docopt(__doc__, version='SizeFS 0.2.2')
     MOUNT_POINT = ARGUMENTS['<mount_point>']
     DEBUG = ARGUMENTS['--debug']
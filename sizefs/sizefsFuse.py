@@ -3,23 +3,79 @@
 SizeFS content generators
 """
 import logging
-import os
 
 from collections import defaultdict
-from errno import ENOENT, EPERM, ENODATA, ENOTEMPTY
+from errno import ENOENT, EPERM, ENODATA, ENOTEMPTY, EINVAL
+from functools import lru_cache
 from fuse import FuseOSError, Operations, LoggingMixIn, FUSE
 from stat import S_IFDIR, S_IFREG
 from time import time
 
 from .contents import (
-    XegerGen, SizeFSZeroGen, SizeFSOneGen, FILE_REGEX, SizeFSAlphaNumGen,
-    SizeFSGeneratorType, ONE_K
+    XegerGen, SizeFSZeroGen, SizeFSOneGen, parse_filename, file_size,
+    SizeFSAlphaNumGen, SizeFSGeneratorType
 )
 
 
 __author__ = "Mark McArdle, Joel Wright"
 
 
+@lru_cache(maxsize=4096)
+def _split(path):
+    """
+    Split a path into its folder and name, like os.path.split() but cheaper
+    for the plain paths that FUSE hands us
+
+    FUSE asks about the same paths over and over, so splits are cached.
+    """
+    index = path.rfind('/')
+    if index < 0:
+        return '', path
+    return path[:index] or '/', path[index + 1:]
+
+
+def _join(folder, name):
+    """
+    Join a folder and a name, like os.path.join() for plain paths
+    """
+    if folder.endswith('/'):
+        return folder + name
+    return folder + '/' + name
+
+
+def _xattr_name(name):
+    """
+    Put a bare xattr name in the user namespace, e.g. filler is user.filler
+    """
+    if '.' in name:
+        return name
+    return 'user.' + name
+
+
+class FileRecord:
+    """
+    A file's stat attributes and its content generator, which is None until
+    the file is next read
+
+    The generator's read method is bound once, whenever the generator is
+    set, so reads don't have to look it up each time.
+    """
+    __slots__ = ('attrs', '_generator', 'read')
+
+    def __init__(self, attrs, generator=None):
+        self.attrs = attrs
+        self.generator = generator
+
+    @property
+    def generator(self):
+        return self._generator
+
+    @generator.setter
+    def generator(self, generator):
+        self._generator = generator
+        self.read = generator.read if generator is not None else None
+
+
 class SizefsFuse(Operations):
     """
     Size Filesystem.
@@ -33,31 +89,44 @@ class SizefsFuse(Operations):
     """
 
     default_files = ['100K', '4M', '4M-1B', '4M+1B']
-    sizes = {'B': 1, 'K': ONE_K, 'M': ONE_K**2, 'G': ONE_K**3,
-             'T': ONE_K**4, 'P': ONE_K**5, 'E': ONE_K**6}
+    generator_xattrs = frozenset([
+        'user.generator', 'user.filler', 'user.prefix', 'user.suffix',
+        'user.padder', 'user.max_random'
+    ])
+    # These generators don't depend on a file's path or size, so one of each
+    # serves every file
+    zero_gen = SizeFSZeroGen()
+    one_gen = SizeFSOneGen()
+    alpha_num_gen = SizeFSAlphaNumGen()
 
     def __init__(self):
         self.folders = {}
         self.files = {}
         self.xattrs = {}
-        self.data = defaultdict(bytes)
+        # Names of the files and folders in each folder
+        self.children = defaultdict(set)
         self.fd = 0
         now = time()
         self.folders['/'] = dict(st_mode=(S_IFDIR | 0o0664), st_ctime=now,
                                  st_mtime=now, st_atime=now, st_nlink=0)
         self.xattrs['/'] = {}
+        # Sized once here rather than for each of the default dirs
+        self.default_file_sizes = [
+            (name, file_size(parse_filename(name)))
+            for name in self.default_files
+        ]
 
         # Create the default dirs (zeros, ones, common)
         self.mkdir('/zeros', (S_IFDIR | 0o0664))
-        self.setxattr('/zeros', u'user.generator',
+        self.setxattr('/zeros', 'user.generator',
                       SizeFSGeneratorType.ZEROS, None)
         self._add_default_files('/zeros')
         self.mkdir('/ones', (S_IFDIR | 0o0664))
-        self.setxattr('/ones', u'user.generator',
+        self.setxattr('/ones', 'user.generator',
                       SizeFSGeneratorType.ONES, None)
         self._add_default_files('/ones')
         self.mkdir('/alpha_num', (S_IFDIR | 0o0664))
-        self.setxattr('/alpha_num', u'user.generator',
+        self.setxattr('/alpha_num', 'user.generator',
                       SizeFSGeneratorType.ALPHA_NUM, None)
         self._add_default_files('/alpha_num')
 
@@ -81,41 +150,13 @@ class SizefsFuse(Operations):
         anywhere but within folders created to serve regex filled files, and
         only with valid filenames
         """
-        (folder, filename) = os.path.split(path)
+        (folder, filename) = _split(path)
 
         if folder in self.folders:
-            _m = FILE_REGEX.match(filename)
-            if _m:
-                attrs = self._file_attrs(_m)
-                size_bytes = attrs['st_size']
-
-                # Get the inherited xattrs from the containing folder and
-                # create the content generator
-                folder_xattrs = self.xattrs[folder]
-                generator = folder_xattrs.get(u'user.generator', None)
-                filler = folder_xattrs.get(u'user.filler', None)
-                prefix = folder_xattrs.get(u'user.prefix', None)
-                suffix = folder_xattrs.get(u'user.suffix', None)
-                padder = folder_xattrs.get(u'user.padder', None)
-                max_random = folder_xattrs.get(u'user.max_random', u'10')
-
-                self.xattrs[path] = {}
-                if generator is not None:
-                    self.setxattr(path, u'user.generator', generator, None)
-                if filler is not None:
-                    self.setxattr(path, u'user.filler', filler, None)
-                if prefix is not None:
-                    self.setxattr(path, u'user.prefix', prefix, None)
-                if suffix is not None:
-                    self.setxattr(path, u'user.suffix', suffix, None)
-                if padder is not None:
-                    self.setxattr(path, u'user.padder', padder, None)
-                self.setxattr(path, u'user.max_random', max_random, None)
-
-                self.files[path] = {
-                    'attrs': attrs,
-                    'generator': self._create_generator(path, size_bytes)
-                }
+            groups = parse_filename(filename)
+            if groups:
+                # The generator is built when the file is first read
+                self._add_file(path, folder, filename, file_size(groups))
             else:
                 raise FuseOSError(EPERM)
         else:
@@ -130,38 +171,34 @@ class SizefsFuse(Operations):
         self.folders map, or it returns a standard attribute dict for any valid
         files
         """
-        if path in self.folders:
-            return self.folders[path]
-
-        if path in self.files:
-            return self.files[path]['attrs']
-
-        (folder, filename) = os.path.split(path)
-
-        if filename == ".":
-            if folder in self.folders:
-                return self.folders[folder]
+        attrs = self.folders.get(path)
+        if attrs is not None:
+            return attrs
+
+        file = self.files.get(path)
+        if file is not None:
+            return file.attrs
+
+        (folder, filename) = _split(path)
+
+        # The kernel resolves these itself, so they rarely reach us
+        if path.endswith(('/.', '/..')):
+            if filename == "..":
+                (folder, child_folder) = _split(folder)
+            attrs = self.folders.get(folder)
+            if attrs is not None:
+                return attrs
             else:
                 raise FuseOSError(ENOENT)
 
-        if filename == "..":
-            (parent_folder, child_folder) = os.path.split(folder)
-            if parent_folder in self.folders:
-                return self.folders[parent_folder]
-            else:
-                raise FuseOSError(ENOENT)
-
-        if folder == "/":
-            raise FuseOSError(ENOENT)
-        else:
-            try:
-                self.create(path, 0o0444)
-                return self.getattr(path)
-            except FuseOSError as e:
-                if e.errno == EPERM:
-                    raise FuseOSError(ENOENT)
-                else:
-                    raise e
+        # Files are created on lookup, but only in a folder other than the
+        # root and with a valid name, check both before adding anything
+        if folder != "/" and folder in self.folders:
+            groups = parse_filename(filename)
+            if groups:
+                return self._add_file(path, folder, filename,
+                                      file_size(groups)).attrs
+        raise FuseOSError(ENOENT)
 
     def getxattr(self, path, name, position=0):
         """
@@ -169,17 +206,14 @@ class SizefsFuse(Operations):
 
         If the xattr does not exist we return ENODATA (synonymous with ENOATTR)
         """
-        if '.' not in name and not name.startswith(u'user.'):
-            name = u'user.%s' % name
-        else:
-            name = u'%s' % name
+        name = _xattr_name(name)
 
         if path in self.xattrs:
-            path_xattrs = self.xattrs[path]
+            path_xattrs = self._get_xattrs(path)
             if name in path_xattrs:
                 return path_xattrs[name]
 
-            if name.startswith(u'com.apple.'):
+            if name.startswith('com.apple.'):
                 try:
                     from errno import ENOTSUP
                     raise FuseOSError(ENOTSUP)
@@ -192,27 +226,26 @@ class SizefsFuse(Operations):
         """
         Return a list of all extended attribute names for a file/folder
         """
-        path_xattrs = self.xattrs.get(path, {})
-        xattr_names = map(
-            lambda xa: xa if xa.startswith(u'user.') else xa[5:], path_xattrs
-        )
-        return xattr_names
+        if path in self.xattrs:
+            return list(self._get_xattrs(path))
+        return []
 
     def mkdir(self, path, mode):
         """
         Here we ignore the mode because we only allow 0444 directories to be
         created
         """
-        (parent, folder) = os.path.split(path)
+        (parent, folder) = _split(path)
 
         if not parent == "/":
             raise FuseOSError(EPERM)
 
+        now = time()
         self.folders[path] = dict(st_mode=(S_IFDIR | 0o0664), st_nlink=2,
-                                  st_size=0, st_ctime=time(), st_mtime=time(),
-                                  st_atime=time())
-        self.xattrs[path] = {}
-        self.xattrs[path][u'user.generator'] = SizeFSGeneratorType.ONES
+                                  st_size=0, st_ctime=now, st_mtime=now,
+                                  st_atime=now)
+        self.xattrs[path] = {'user.generator': SizeFSGeneratorType.ONES}
+        self.children[parent].add(folder)
         self.folders['/']['st_nlink'] += 1
 
     def open(self, path, flags):
@@ -230,68 +263,62 @@ class SizefsFuse(Operations):
         """
         Returns content based on the pattern of the containing folder
         """
-        if path in self.files:
-            size_bytes = self.files[path]['attrs']['st_size']
-            if offset > (size_bytes - 1):
-                return ""
-            else:
-                end_of_content = min(offset+size, size_bytes)
-                content = self.files[path]['generator'].read(
-                    offset, end_of_content
-                )
-                return content
-        else:
+        file = self.files.get(path)
+        if file is None:
             self.create(path, 0o0444)
-            return self.read(path, size, offset, fh)
-
-    def readdir(self, path, fh):
-        contents = ['.', '..']
+            file = self.files[path]
 
-        if path == "/":
-            for folder_path in self.folders:
-                if not folder_path == "/":
-                    (parent, folder_name) = os.path.split(folder_path)
-                    if parent == path:
-                        contents.append(folder_name)
-            for file_path in self.files:
-                (folder, filename) = os.path.split(file_path)
-                if folder == "/":
-                    contents.append(filename)
+        size_bytes = file.attrs['st_size']
+        if offset >= size_bytes:
+            return b""
         else:
-            for file_path in self.files:
-                if file_path.startswith(path):
-                    (folder, filename) = os.path.split(file_path)
-                    contents.append(filename)
+            # Generators read up to an inclusive end
+            end = offset + size - 1
+            if end >= size_bytes:
+                end = size_bytes - 1
+            read = file.read or self._get_generator(path).read
+            return read(offset, end)
 
+    def readdir(self, path, fh):
+        """
+        List a folder from its children, without looking at other folders
+        """
+        if path not in self.folders:
+            raise FuseOSError(ENOENT)
+        contents = ['.', '..']
+        contents.extend(self.children.get(path, ()))
         return contents
 
     def readlink(self, path):
-        return self.data[path]
+        """
+        Symlinks can't be created, so nothing is a link
+        """
+        if path in self.files or path in self.folders:
+            raise FuseOSError(EINVAL)
+        raise FuseOSError(ENOENT)
 
     def removexattr(self, path, name):
-        if '.' not in name and not name.startswith(u'user.'):
-            name = u'user.%s' % name
-        else:
-            name = u'%s' % name
+        """
+        Remove an extended attribute from a file/folder
+
+        Removing a file's own value brings back the one it inherits, if any.
+        Removing an inherited value masks it for that file alone.
+        """
+        name = _xattr_name(name)
 
         path_xattrs = self.xattrs[path]
 
-        if name in path_xattrs:
+        if path_xattrs.get(name) is not None:
             del path_xattrs[name]
             self._update_mtime(path)
+        elif name in self._get_xattrs(path):
+            path_xattrs[name] = None
+            self._update_mtime(path)
         else:
             raise FuseOSError(ENODATA)
 
-        if path in self.folders:
-            file_names = self.files.keys()
-            files_to_update = [filename for filename in file_names
-                               if filename.startswith(path)]
-            for file in files_to_update:
-                self.removexattr(file, name)
-        elif path in self.files:
-            size_bytes = self.files[path]['attrs']['st_size']
-            self.files[path]['generator'] =\
-                self._create_generator(path, size_bytes)
+        if name in self.generator_xattrs:
+            self._reset_generators(path, name)
 
     def rename(self, old, new):
         """
@@ -302,27 +329,41 @@ class SizefsFuse(Operations):
         a file changes the meaning of its content generator.
         """
         if old in self.folders:
-            if new in self.folders:
+            (new_parent, new_name) = _split(new)
+            # Like mkdir, only allow one level of folders
+            if (old == '/' or new_parent != '/' or new in self.folders or
+                    new in self.files):
                 raise FuseOSError(EPERM)
 
             self.folders[new] = self.folders.pop(old)
-            for file in self.files:
-                (folder, filename) = os.path.split(file)
-                if old == folder:
-                    new_path = os.path.join(new, filename)
-                    self.files[new_path] = self.files.pop(file)
+            self.xattrs[new] = self.xattrs.pop(old)
+            children = self.children.pop(old, set())
+            for filename in children:
+                old_path = _join(old, filename)
+                new_path = _join(new, filename)
+                self.files[new_path] = self.files.pop(old_path)
+                self.xattrs[new_path] = self.xattrs.pop(old_path)
+            if children:
+                self.children[new] = children
+
+            (old_parent, old_name) = _split(old)
+            self.children[old_parent].discard(old_name)
+            self.children[new_parent].add(new_name)
+        elif old in self.files:
+            raise FuseOSError(EPERM)
         else:
             raise FuseOSError(ENOENT)
 
     def rmdir(self, path):
         if path in self.folders:
-            for file in self.files:
-                (parent_folder, filename) = os.path.split(file)
-                if parent_folder == path:
-                    raise FuseOSError(ENOTEMPTY)
+            if self.children.get(path):
+                raise FuseOSError(ENOTEMPTY)
 
             del self.folders[path]
             del self.xattrs[path]
+            self.children.pop(path, None)
+            (parent, folder) = _split(path)
+            self.children[parent].discard(folder)
             self.folders['/']['st_nlink'] -= 1
         else:
             raise FuseOSError(ENOENT)
@@ -330,32 +371,22 @@ class SizefsFuse(Operations):
     def setxattr(self, path, name, value, options, position=0):
         # Ignore options
 
-        if '.' not in name and not name.startswith(u'user.'):
-            name = u'user.%s' % name
-        else:
-            name = u'%s' % name
+        name = _xattr_name(name)
 
         if path in self.xattrs:
-            path_xattrs = self.xattrs[path]
+            # Files only get their own value if it differs from the one
+            # they already have, inherited or not
+            path_xattrs = self._get_xattrs(path)
             if name in path_xattrs and value == path_xattrs[name]:
                 return
             else:
                 self._update_mtime(path)
-            path_xattrs[name] = value
+            self.xattrs[path][name] = value
         else:
             raise FuseOSError(ENOENT)
 
-        if path in self.folders:
-            filenames = self.files.keys()
-            files_to_update = [filename for filename in filenames
-                               if filename.startswith(path)]
-            for file in files_to_update:
-                self.setxattr(file, name, value, options, position)
-
-        elif path in self.files:
-            size_bytes = self.files[path]['attrs']['st_size']
-            self.files[path]['generator'] =\
-                self._create_generator(path, size_bytes)
+        if name in self.generator_xattrs:
+            self._reset_generators(path, name)
 
     def statfs(self, path):
         return dict(f_bsize=512, f_blocks=4096, f_bavail=2048)
@@ -370,6 +401,8 @@ class SizefsFuse(Operations):
         if path in self.files:
             del self.files[path]
             del self.xattrs[path]
+            (folder, filename) = _split(path)
+            self.children[folder].discard(filename)
         else:
             raise FuseOSError(ENOENT)
 
@@ -379,78 +412,136 @@ class SizefsFuse(Operations):
     def write(self, path, data, offset, fh):
         raise FuseOSError(EPERM)
 
-    def _calculate_file_size(self, regex_match):
-        file_groupdict = regex_match.groupdict()
-        init_size = float(file_groupdict["size"])
-        size_unit = self.sizes[file_groupdict["size_si"]]
-        size = int(init_size * size_unit)
-
-        operator = file_groupdict["operator"]
-        if operator is not None:
-            shift = file_groupdict["shift"]
-            shift_unit = self.sizes[file_groupdict["shift_si"]]
-            shift_size = int(shift) * shift_unit
-            if operator == "-":
-                size -= shift_size
-            elif operator == "+":
-                size += shift_size
-
-        if size < 0:
-            return 0
-        else:
-            return int(size)
-
-    def _file_attrs(self, m):
-        size = self._calculate_file_size(m)
+    def _file_attrs(self, size, now=None):
+        if now is None:
+            now = time()
         return dict(st_mode=(S_IFREG | 0o0444), st_nlink=1,
-                    st_size=size, st_ctime=time(),
-                    st_mtime=time(), st_atime=time())
+                    st_size=size, st_ctime=now,
+                    st_mtime=now, st_atime=now)
 
     def _update_mtime(self, path):
         if path in self.folders:
             self.folders[path]['st_mtime'] = time()
         elif path in self.files:
-            self.files[path]['attrs']['st_mtime'] = time()
+            self.files[path].attrs['st_mtime'] = time()
+
+    def _get_xattrs(self, path):
+        """
+        Return the xattrs of a file or folder, including those a file
+        inherits from its folder
+
+        A file masks an inherited xattr it has removed with a value of None.
+        """
+        path_xattrs = self.xattrs[path]
+        if path not in self.folders:
+            (folder, filename) = _split(path)
+            folder_xattrs = self.xattrs.get(folder)
+            if folder_xattrs or path_xattrs:
+                inherited = dict(folder_xattrs or ())
+                for name, value in path_xattrs.items():
+                    if value is None:
+                        inherited.pop(name, None)
+                    else:
+                        inherited[name] = value
+                return inherited
+        return path_xattrs
+
+    def _reset_generators(self, path, name):
+        """
+        Drop the generators affected by a change to an xattr, they are
+        rebuilt on the next read so a run of changes only pays once
+        """
+        if path in self.files:
+            self.files[path].generator = None
+        elif path in self.folders:
+            for file in self._child_files(path):
+                # Files with their own value don't see the folder's
+                if name not in self.xattrs[file]:
+                    self.files[file].generator = None
+
+    def _child_files(self, path):
+        """
+        Yield the paths of the files directly within a folder, skipping its
+        sub-folders
+        """
+        for name in self.children.get(path, ()):
+            child = _join(path, name)
+            if child in self.files:
+                yield child
+
+    def _add_file(self, path, folder, filename, size, now=None):
+        """
+        Add a file record of 'size' bytes without a generator, created at
+        'now' if given
+        """
+        # Files only hold the xattrs they override, the rest are inherited
+        # from the containing folder when they are read
+        self.xattrs[path] = {}
+        file = self.files[path] = FileRecord(self._file_attrs(size, now))
+        self.children[folder].add(filename)
+        return file
 
     def _add_default_files(self, path):
         """
         Add a set of example files to a directory (only for demo dirs)
+
+        Their generators are left to be built on first read, most of them
+        are never read.
         """
-        for default_file in self.default_files:
-            new_filepath = os.path.join(path, default_file)
-            self.create(new_filepath, 0o0444)
+        now = time()
+        for (default_file, size) in self.default_file_sizes:
+            self._add_file(_join(path, default_file), path, default_file,
+                           size, now)
+
+    def _get_generator(self, path):
+        """
+        Return the generator for a file, creating it if its xattrs have
+        changed since it was last used
+        """
+        file = self.files[path]
+        generator = file.generator
+        if generator is None:
+            generator = file.generator = self._create_generator(
+                path, file.attrs['st_size'])
+        return generator
 
     def _create_generator(self, path, size_bytes):
         """
         Create a generator from xattr values
         """
-        generator = self.xattrs[path].get(u'user.generator', None)
+        path_xattrs = self._get_xattrs(path)
+        generator = path_xattrs.get('user.generator', None)
         if generator == SizeFSGeneratorType.ALPHA_NUM:
-            return SizeFSAlphaNumGen()
+            return self.alpha_num_gen
         elif generator == SizeFSGeneratorType.ZEROS:
-            return SizeFSZeroGen()
+            return self.zero_gen
         elif generator == SizeFSGeneratorType.ONES:
-            return SizeFSOneGen()
+            return self.one_gen
         elif generator == SizeFSGeneratorType.REGEX:
-            filler = self.xattrs[path].get(u'user.filler', None)
-            prefix = self.xattrs[path].get(u'user.prefix', None)
-            suffix = self.xattrs[path].get(u'user.suffix', None)
-            padder = self.xattrs[path].get(u'user.padder', None)
-            max_random = self.xattrs[path].get(u'user.max_random', u'10')
+            filler = path_xattrs.get('user.filler', None)
+            prefix = path_xattrs.get('user.prefix', None)
+            suffix = path_xattrs.get('user.suffix', None)
+            padder = path_xattrs.get('user.padder', None)
+            max_random = path_xattrs.get('user.max_random', '10')
+            try:
+                max_random = max(0, int(max_random))
+            except ValueError:
+                logging.warning('Invalid max_random %r for %s',
+                                max_random, path)
+                max_random = 10
 
             genr = XegerGen(size_bytes,
                             filler=filler,
                             prefix=prefix,
                             suffix=suffix,
                             padder=padder,
-                            max_random=int(max_random))
+                            max_random=max_random)
 
             return genr
         else:
-            logging.log(logging.WARNING,
-                        'Unknown generator %s for %s' % (generator, path))
-            self.xattrs[path][u'user.generator'] = SizeFSGeneratorType.ONES
-            return SizeFSOneGen()
+            logging.warning('Unknown generator %s for %s', generator, path)
+            self.xattrs[path]['user.generator'] = SizeFSGeneratorType.ONES
+            return self.one_gen
 
     @classmethod
     def mount(cls, mount_point, debug=False):
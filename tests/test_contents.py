@@ -1,168 +1,492 @@
 #!/usr/bin/env python
 import pytest
+import random
 import re
+import threading
 
 from sizefs.contents import (
-    XegerExpression, XegerGen, XegerError, XegerMultiplier,
-    SizeFSGen, SizeFSZeroGen,
+    Xeger, XegerExpression, XegerGen, XegerError, XegerMultiplier, XegerSet,
+    SizeFSGen, SizeFSZeroGen, SizeFSOneGen, SizeFSAlphaNumGen, FastRandom,
+    _xeger_factory, FILE_REGEX, parse_filename, file_size, _Cursor,
 )
 
 __author__ = "Joel Wright, Mark McArdle"
 
+# Whole files of repeated filler, followed by any default padding
+STAR_REGEX = re.compile(b"(?:a(?:bc)*d)+0*")
+PLUS_REGEX = re.compile(b"(?:a(?:bc)+d)+0*")
+CHOICE_REGEX = re.compile(b"(?:a[012345]{14}b)+0*")
+RANGE_REGEX = re.compile(b"(?:a[0-9,a-z,A-Z]{5}d)+0*")
+
 
 def test_sizefs_gen():
     generator = SizeFSGen()
-    contents = generator.read(0, 15)
-    assert contents == "XXXXXXXXXXXXXXX"
+    contents = generator.read(0, 14)
+    assert contents == b"XXXXXXXXXXXXXXX"
+
+
+def test_sizefs_gen_fill():
+    generator = SizeFSGen()
+    generator.chars = b"abc"
+    assert generator.fill(7) == b"abcabca"
+    assert generator.fill(0) == b""
+    assert generator.fill(7, 4) == b"bcabcab"
+    assert generator.fill(2, 4) == b"bc"
+    assert generator.fill(3, 3) == b"abc"
+    assert generator.read(4, 10) == b"bcabcab"
 
 
 def test_sizefs_zero_gen():
     generator = SizeFSZeroGen()
-    contents = generator.read(0, 15)
-    assert contents == "000000000000000"
+    contents = generator.read(0, 14)
+    assert contents == b"000000000000000"
+    # FUSE sized reads, and reads far into a large file
+    assert generator.read(0, 131071) == b"0" * 131072
+    assert generator.read(2 ** 40, 2 ** 40 + 9) == b"0" * 10
+
+
+def test_sizefs_one_gen():
+    generator = SizeFSOneGen()
+    assert generator.read(5, 9) == b"11111"
+    assert generator.read(9, 9) == b"1"
+    assert generator.read(10, 9) == b""
+    assert generator.fill(3, 7) == b"111"
+
+
+def test_sizefs_char_gen_reuses_results():
+    generator = SizeFSOneGen()
+    block = generator.read(0, 131071)
+    assert generator.read(131072, 262143) is block
+    assert generator.read(0, 3) == b"1111"
+    assert generator.read(5, 5) == b"1"
+    assert generator.read(1, 0) == b""
+    # Results too large to keep around are rebuilt each time
+    size = SizeFSOneGen.MAX_CACHED + 1
+    huge = generator.read(0, size - 1)
+    assert len(huge) == size
+    assert generator.read(0, size - 1) is not huge
+
+
+def test_sizefs_alpha_num_gen_reuses_aligned_results():
+    generator = SizeFSAlphaNumGen()
+    cycle = SizeFSAlphaNumGen.NUM_CHARS
+    block = generator.read(0, 131071)
+    # 128KiB reads all start at the same place in the random block
+    assert generator.read(131072, 262143) is block
+    shifted = generator.read(10, 131081)
+    assert shifted is not block
+    assert shifted == block[10:] + block[:10]
+    assert generator.read(cycle + 10, cycle + 131081) is shifted
+
+
+def test_sizefs_alpha_num_gen():
+    generator = SizeFSAlphaNumGen()
+    assert len(generator.chars) == SizeFSAlphaNumGen.NUM_CHARS
+    assert not bytearray(generator.chars).translate(
+        None, SizeFSAlphaNumGen.CHARS)
+    assert len(generator._random_chars(1000)) == 1000
+    contents = generator.read(0, 199)
+    assert generator.read(50, 149) == contents[50:150]
+    # Reads wrap around the random block consistently
+    cycle = SizeFSAlphaNumGen.NUM_CHARS
+    long_read = generator.read(100, 100 + 2 * cycle)
+    assert long_read[:cycle] == long_read[cycle:2 * cycle]
+    assert generator.read(cycle + 50, cycle + 149) == contents[50:150]
+    # Content is a function of the offset alone, even gigabytes in
+    far = 5 * 2 ** 30 + 10
+    assert generator.read(far, far + 9) == generator.read(
+        far % cycle, far % cycle + 9)
+    wrap = 7 * cycle - 5
+    assert generator.read(wrap, wrap + 9) == (
+        generator.chars[-5:] + generator.chars[:5])
+
+
+def test_fast_random():
+    fast_random = FastRandom(0, 3, len=4)
+    values = [fast_random.rand() for _ in range(8)]
+    assert values[:4] == values[4:]
+    assert set(values) <= set([0, 1, 2, 3])
+
+
+def test_fast_random_bad_length():
+    with pytest.raises(ValueError):
+        FastRandom(0, 3, len=255)
 
 
 def test_xeger_gen():
     generator = XegerGen(1024, filler="0", max_random=10)
     contents = generator.read(0, 15)
-    assert contents == "0000000000000000"
+    assert contents == b"0000000000000000"
 
 
 def test_xeger_gen_empty_filler():
     generator = XegerGen(64, filler="", max_random=10)
-    assert generator._filler._pattern._sequence == '0'
+    assert generator._filler._pattern._sequence == b'0'
 
 
 def test_xeger_gen_empty_padder():
     generator = XegerGen(64, padder="", max_random=10)
-    assert generator._padder._pattern._sequence == '0'
+    assert generator._padder._pattern._sequence == b'0'
 
 
 def test_xeger_gen_empty_prefix():
     generator = XegerGen(64, prefix="", max_random=10)
-    assert generator._prefix == ""
+    assert generator._prefix == b""
 
 
 def test_xeger_gen_empty_suffix():
     generator = XegerGen(64, suffix="", max_random=10)
-    assert generator._suffix == ""
+    assert generator._suffix == b""
 
 
 def test_xeger_gen_read_beyond_length():
     generator = XegerGen(10, prefix='XX')
     contents1 = generator.read(0, 10)
-    assert contents1 == "XX00000000"
+    assert contents1 == b"XX00000000"
     contents2 = generator.read(0, 10)
-    assert contents2 == "XX00000000"
+    assert contents2 == b"XX00000000"
 
 
 def test_xeger_read_beyond_prefix():
     generator = XegerGen(20, prefix='XX')
     contents1 = generator.read(10, 20)
-    assert contents1 == "0000000000"  # note no prefix
+    assert contents1 == b"0000000000"  # note no prefix
 
 
 def test_xeger_gen_read_before_beginning():
     generator = XegerGen(10, prefix='XX')
     contents = generator.read(-10, 10)
-    assert contents == "XX00000000"
+    assert contents == b"XX00000000"
 
 
 def test_padding():
     # Default padding
     generator = XegerGen(64, filler="55555", max_random=10)
     contents = generator.read(0, 63)
-    assert contents.endswith("50000")
+    assert contents.endswith(b"50000")
     # Longer padding sequence (should be truncated)
     generator = XegerGen(64, filler="55555", padder="longer", max_random=10)
     contents = generator.read(0, 63)
-    assert contents.endswith("5long")
+    assert contents.endswith(b"5long")
     # Longer padding and suffix
     generator = XegerGen(64, filler="55555", padder="longer",
                          max_random=10, suffix="9999999999")
     contents = generator.read(0, 63)
-    assert contents.endswith("5long9999999999")
+    assert contents.endswith(b"5long9999999999")
 
 
 def test_prefix():
     generator = XegerGen(1024, prefix="11", filler="0", max_random=10)
     contents = generator.read(0, 15)
-    assert contents == "1100000000000000"
+    assert contents == b"1100000000000000"
+
+
+def test_prefix_pattern():
+    generator = XegerGen(1024, prefix="1{2}[2]", filler="0", max_random=10)
+    contents = generator.read(0, 15)
+    assert contents == b"1120000000000000"
+
+
+def test_literal_prefix_and_suffix(monkeypatch):
+    # Literal patterns never need a parser
+    parsed = []
+
+    def recording_factory(pattern, max_random):
+        parsed.append(pattern)
+        return _xeger_factory(pattern, max_random)
+    monkeypatch.setattr('sizefs.contents._xeger_factory', recording_factory)
+    generator = XegerGen(16, prefix="ab", suffix="yz", max_random=10)
+    assert parsed == ["0", "0"]
+    assert generator.read(0, 15) == b"ab000000000000yz"
 
 
 def test_suffix():
     generator = XegerGen(16, suffix="1111", filler="0", max_random=10)
     contents = generator.read(0, 15)
-    assert contents == "0000000000001111"
+    assert contents == b"0000000000001111"
 
 
 def test_repeat():
     generator = XegerGen(1024, filler="ab", max_random=10)
     contents = generator.read(0, 15)
-    assert contents == "abababababababab"
+    assert contents == b"abababababababab"
+
+
+def test_constant_filler_tiled():
+    generator = XegerGen(1001, filler="a{2}c", padder="p", max_random=10)
+    generator.FILLER_BLOCK_SIZE = 64
+    assert generator.read(0, 1000) == b"aac" * 333 + b"pp"
+    assert generator.read(500, 505) == (b"aac" * 333)[500:506]
 
 
 def test_star():
-    for _ in range(0, 128):
-        generator = XegerGen(1024, filler="a(bc)*d", max_random=10)
-        contents = generator.read(0, 255)
-        match = re.match("a(bc)*d", contents)
-        assert match is not None
+    # One file holds thousands of filler patterns, each drawn separately
+    generator = XegerGen(32768, filler="a(bc)*d", max_random=10)
+    contents = generator.read(0, 32767)
+    assert STAR_REGEX.fullmatch(contents)
+    assert b"ad" in contents
+    assert b"abcd" in contents
 
 
 def test_plus():
-    for _ in range(0, 128):
-        generator = XegerGen(1024, filler="a(bc)+d", max_random=10)
-        contents = generator.read(0, 255)
-        match = re.match("a(bc)+d", contents)
-        assert match is not None
+    generator = XegerGen(32768, filler="a(bc)+d", max_random=10)
+    contents = generator.read(0, 32767)
+    assert PLUS_REGEX.fullmatch(contents)
+    assert b"ad" not in contents
 
 
 def test_numbered_repeat():
     # Test repeats without overrun
     generator = XegerGen(1024, filler="a(bc){5}d", max_random=10)
     contents = generator.read(0, 15)
-    assert contents == "abcbcbcbcbcdabcb"
-    assert generator._remainder == "cbcbcbcd"
+    assert contents == b"abcbcbcbcbcdabcb"
+    assert generator.read(16, 23) == b"cbcbcbcd"
     # Test repeats with overrun
     generator = XegerGen(16, filler="a(bc){5}d", max_random=10)
     contents = generator.read(0, 15)
-    assert contents == "abcbcbcbcbcd0000"
+    assert contents == b"abcbcbcbcbcd0000"
+
+
+def test_overrun_keeps_filler_order():
+    # Each filler is three separate generator items, the last one overruns
+    generator = XegerGen(1024, filler="a[xy]b", max_random=10)
+    contents = generator.read(0, 3)
+    assert re.match(b"a[xy]ba", contents)
+    assert re.match(b"[xy]b$", generator.read(4, 5))
+
+
+def test_random_seek_consistent():
+    generator = XegerGen(1000, filler="a[0-9]*b", prefix="XX",
+                         suffix="YY", max_random=10)
+    generator.FILLER_BLOCK_SIZE = 64
+    contents = generator.read(0, 999)
+    assert len(contents) == 1000
+    assert contents.startswith(b"XX")
+    assert contents.endswith(b"YY")
+    assert generator.read(500, 599) == contents[500:600]
+    assert generator.read(990, 2000) == contents[990:]
+    assert b"".join(generator.read(i, i + 9)
+                    for i in range(0, 1000, 10)) == contents
+
+
+def test_concurrent_first_reads():
+    generator = XegerGen(100000, filler="a[0-9]*b", max_random=10)
+    results = []
+
+    def read():
+        results.append(generator.read(0, 99999))
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(results)) == 1
 
 
 def test_choice():
-    for _ in range(0, 128):
-        generator = XegerGen(1024, filler="a[012345]{14}b", max_random=10)
-        contents = generator.read(0, 15)
-        match = re.match("a[012345]{14}b", contents)
-        assert match is not None
+    generator = XegerGen(32768, filler="a[012345]{14}b", max_random=10)
+    contents = generator.read(0, 32767)
+    assert CHOICE_REGEX.fullmatch(contents)
 
 
 def test_range():
-    for _ in range(0, 128):
-        generator = XegerGen(1024, filler="a[0-9,a-z,A-Z]{5}d", max_random=10)
-        contents = generator.read(0, 256)
-        match = re.match("a[0-9,a-z,A-Z]{5}d", contents)
-        assert match is not None
+    generator = XegerGen(32768, filler="a[0-9,a-z,A-Z]{5}d", max_random=10)
+    contents = generator.read(0, 32767)
+    assert RANGE_REGEX.fullmatch(contents)
+
+
+def test_xeger_gen_shares_parsed_patterns():
+    _xeger_factory.cache_clear()
+    generator1 = XegerGen(64, filler="a(bc)*d", max_random=10)
+    generator2 = XegerGen(128, filler="a(bc)*d", max_random=10)
+    assert generator1._filler is generator2._filler
+    assert generator1._padder is generator2._padder
+    generator3 = XegerGen(64, filler="a(bc)*d", max_random=5)
+    assert generator3._filler is not generator1._filler
+    _xeger_factory.cache_clear()
+    generator4 = XegerGen(64, filler="a(bc)*d", max_random=10)
+    assert generator4._filler is not generator1._filler
+
+
+def test_xeger_gen_own_filler_stream():
+    generator1 = XegerGen(50000, filler="a[0-9]*b", max_random=10)
+    generator2 = XegerGen(50000, filler="a[0-9]*b", max_random=10)
+    contents = generator1.read(0, 4999)
+    # A small read only generates about as much filler as it needs
+    data, _ = generator1._stream.extend_to(0, 0)
+    assert len(data) < 10000
+    # Files sharing a pattern get their own random content
+    assert generator2.read(0, 4999) != contents
+    # which stays the same as the rest of the file is generated
+    assert generator1.read(0, 49999)[:5000] == contents
+    assert generator1.read(0, 4999) == contents
+
+
+def test_xeger_max_random_reaches_multipliers():
+    # Programs pooled under different max_random values must really differ
+    for _ in range(20):
+        content = bytearray()
+        Xeger("a*", max_random=2).generate(content)
+        assert len(content) <= 2
+        content = bytearray()
+        Xeger("(ab)+", max_random=1).generate(content)
+        assert content == b"ab"
+
+    xeger = Xeger("a*", max_random=10000)
+    lengths = []
+    for _ in range(5):
+        content = bytearray()
+        xeger.generate(content)
+        lengths.append(len(content))
+    assert max(lengths) > 10
+
+
+def test_xeger_max_random_below_one():
+    # + still repeats once and * not at all, rather than failing to build
+    for max_random in (0, -3):
+        content = bytearray()
+        Xeger("a+b*c", max_random=max_random).generate(content)
+        assert content == b"ac"
+
+
+def test_xeger_deeply_nested_pattern():
+    # Too many nested loops to compile, so the parse tree generates it
+    pattern = "(" * 25 + "a?" + ")?" * 25 + "b"
+    for _ in range(20):
+        content = bytearray()
+        Xeger(pattern).generate(content)
+        assert content in (b"b", b"ab")
+    generator = XegerGen(64, filler=pattern, max_random=10)
+    assert re.fullmatch(b"(a?b)+0*", generator.read(0, 63))
+
+
+def test_xeger_constant_pattern():
+    xeger = Xeger("a{2}(bc){2}d")
+    assert xeger.constant_bytes == b"aabcbcd"
+    content = bytearray()
+    xeger.generate(content)
+    assert content == b"aabcbcd"
+
+
+def test_xeger_random_pattern_not_constant():
+    assert Xeger("a(bc)*d").constant_bytes is None
+    assert Xeger("a[bc]{2}").constant_bytes is None
+
+
+def test_xeger_compiled_matches_parse_tree():
+    for pattern in ["a(bc)*d", "[a-z]{8}x", "a((b)c*[xy]){3}d", "(a{0})+b?"]:
+        random.seed(pattern)
+        compiled = Xeger(pattern)
+        random.seed(pattern)
+        interpreted = Xeger(pattern)
+        expected = bytearray()
+        content = bytearray()
+        for _ in range(50):
+            compiled.generate(content)
+            interpreted._pattern.generate(expected)
+        assert content == expected
+
+
+def test_xeger_nested_pattern():
+    xeger = Xeger("a((b)c{2}){2}d")
+    content = bytearray()
+    xeger.generate(content)
+    assert content == b"abccbccd"
+    with pytest.raises(XegerError):
+        Xeger("a((b)c")
+
+
+def test_xeger_set_generate_n():
+    xeger_set = XegerSet(_Cursor("a-z]"))
+    for count in (0, 1, 255, 256, 300, 100000):
+        xeger_set._random.index = 7
+        content = bytearray()
+        xeger_set.generate_n(content, count)
+        xeger_set._random.index = 7
+        expected = bytearray()
+        for _ in range(count):
+            xeger_set.generate(expected)
+        assert content == expected
+
+
+def test_xeger_set_bytes():
+    xeger_set = XegerSet(_Cursor("a-c\\-x]"))
+    assert xeger_set._set == (b"a", b"b", b"c", b"-", b"x")
+
+
+def test_xeger_set_multibyte_members():
+    # Members are picked whole, never a lone byte of their encoding
+    xeger_set = XegerSet(_Cursor("\u00e9a\u00fe-\u0100]"))
+    assert xeger_set._set == (
+        "\u00e9".encode(), b"a", "\u00fe".encode(), "\u00ff".encode(),
+        "\u0100".encode())
+    content = bytearray()
+    for _ in range(300):
+        xeger_set.generate(content)
+    xeger_set.generate_n(content, 1000)
+    text = content.decode("utf-8")
+    assert len(text) == 1300
+    assert set(text) == set("\u00e9a\u00fe\u00ff\u0100")
+
+    generator = XegerGen(4096, filler="[\u00e9a]{3}x", max_random=10)
+    assert generator.read(0, 4095).decode("utf-8")
 
 
 def tests_xeger_expression_multiplier():
-    xger = XegerExpression(['a{2}b{2}c'])
-    assert xger._generator._sequence == 'a{2}b{2}c'
+    xger = XegerExpression(_Cursor(['a{2}b{2}c']))
+    assert xger._generator._sequence == b'a{2}b{2}c'
     assert xger._constant_multiplier is None
     assert xger._multiplier is None
 
 
 def tests_xeger_multiplier_illegal_end_of_mulitplier():
     with pytest.raises(XegerError):
-        XegerMultiplier(['}'])
+        XegerMultiplier(_Cursor('}'))
 
 
 def tests_xeger_multiplier_illegal_pattern():
     with pytest.raises(XegerError):
-        XegerMultiplier(['{', '*'])
+        XegerMultiplier(_Cursor('{*'))
 
 
 def tests_xeger_multiplier_illegal_end():
     with pytest.raises(XegerError):
-        XegerMultiplier(['{'])
+        XegerMultiplier(_Cursor('{'))
+
+
+def test_parse_filename():
+    assert parse_filename("4M") == {"size": "4", "size_si": "M",
+                                    "operator": None, "shift": None,
+                                    "shift_si": None}
+    assert parse_filename("1.5G")["size"] == "1.5"
+    assert parse_filename("4M-1B")["shift"] == "1"
+    assert parse_filename("4M") is parse_filename("4M")
+    with pytest.raises(TypeError):
+        parse_filename("4M")["size"] = "5"
+    for name in ["4M", "1.1T", "100K", "4M+1B", "4M-12K", "1.5G-1B", "M",
+                 "4", "4X", "1.55K", "1.K", ".5K", "4M+", "4M+1", "a4M",
+                 "4m", "", "\u0664M", "4M+1B-1B", "4M--1B", "4M+B"]:
+        match = FILE_REGEX.match(name)
+        expected = match.groupdict() if match else None
+        assert parse_filename(name) == expected
+    # FILE_REGEX's $ also matches before a trailing newline
+    assert parse_filename("4M\n") is None
+    assert parse_filename("4M|1B") is None
+    assert parse_filename("4M+\u0664B") is None
+
+
+def test_file_regex_operator():
+    # The shift operator is + or -, the | in the class was never meant
+    assert FILE_REGEX.match("4M+1B").group("operator") == "+"
+    assert FILE_REGEX.match("4M-1B").group("operator") == "-"
+    assert FILE_REGEX.match("4M|1B") is None
+
+
+def test_file_size():
+    sizes = {'4M': 4000000, '4M+1B': 4000001, '4M-1B': 3999999,
+             '100K+10K': 110000, '1.5K': 1500, '1B-2B': 0, '0.5B': 0,
+             '1E': 1000 ** 6, '1.1E': 1100000000000000000,
+             '2P-1T': 1999 * 1000 ** 4}
+    for name, size in sizes.items():
+        assert file_size(parse_filename(name)) == size
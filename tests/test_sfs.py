@@ -1,11 +1,15 @@
 import pytest
+import subprocess
+import sys
 
 from fs.errors import ResourceInvalidError, ResourceNotFoundError
 
 from sizefs.contents import (
     SizeFSAlphaNumGen, SizeFSOneGen, SizeFSZeroGen
 )
-from sizefs.sizefs import SizeFS, SizeFile, DirEntry, doc_test
+from sizefs.sizefs import (
+    SizeFS, SizeFile, DirEntry, doc_test, OPEN_CACHE_SIZE
+)
 
 
 __author__ = "Mark McArdle, Joel Wright"
@@ -16,6 +20,13 @@ def sfs():
     return SizeFS()
 
 
+def test_import_without_fuse():
+    # Only mounting needs fusepy, and with it libfuse
+    subprocess.check_call([
+        sys.executable, '-c',
+        'import sys, sizefs; assert "fuse" not in sys.modules'])
+
+
 def test_doc_test():
     doc_test()
 
@@ -51,7 +62,6 @@ def test_multiple_binary_reads(sfs):
 
 
 def test_bad_files(sfs):
-    sfs = SizeFS()
     with pytest.raises(ValueError):
         sfs.open('X')
     with pytest.raises(ValueError):
@@ -66,12 +76,11 @@ def test_size_file():
     assert zero_sf.read(1) == '0'
     one_sf = SizeFile('/1', 1, filler=SizeFSOneGen())
     assert one_sf.read(1) == '1'
-    alpha_sf = SizeFile('/1', 1, filler=SizeFSAlphaNumGen())
+    alpha_sf = SizeFile('/1', 1, mode='rb', filler=SizeFSAlphaNumGen())
     assert alpha_sf.read(1) in SizeFSAlphaNumGen.CHARS
 
 
 def test_files(sfs):
-    sfs = SizeFS()
     assert not sfs.isfile('/nofile')
 
     # Not Implemented
@@ -128,12 +137,24 @@ def test_files(sfs):
         sfs.open('/sub/sub')
 
 
+def test_size_file_chunks_reuse_content():
+    filler = SizeFSAlphaNumGen()
+    block = len(filler.chars)
+    sf = SizeFile('/1', block * 4, mode='rb', filler=filler)
+    first = sf.read(block)
+    assert first == filler.chars
+    # Whole blocks of a repeating filler are the same bytes every time
+    assert sf.read(block) is first
+    assert sf.read(block * 2) == first * 2
+
+
 def test_read_size_file(sfs):
     size = 1000
     chunk = 100
     beyond = size + 10
     chunks = int(size/chunk)
     name = '/%s' % size
+    zeros = SizeFSZeroGen.CHARS.decode() * size
 
     sf = SizeFile(name, size)
     count = 0
@@ -143,15 +164,15 @@ def test_read_size_file(sfs):
     assert count == chunks
     assert sf.tell() == 0
 
-    # Read in 10 bytes chunks
+    # Read everything that's left
     sf2 = SizeFile(name, size)
     read = sf2.read(sf2.tell())
-    assert read == SizeFSZeroGen.CHARS*size
+    assert read == zeros
 
     # Read whole file
     sf3 = SizeFile(name, size)
     read = sf3.read()
-    assert read == SizeFSZeroGen.CHARS*size
+    assert read == zeros
 
     # Read beyond end of file
     sf3 = SizeFile(name, size)
@@ -220,12 +241,40 @@ def test_alpha_num(sfs):
     assert len(sfs.open('/alpha_num/2B').read(2)) == 2
 
 
+def test_shared_fillers(sfs):
+    for folder in (sfs.zeros, sfs.ones, sfs.alpha_num):
+        for entry in folder.contents.values():
+            assert entry.filler is folder.filler
+    for entry in sfs.common.contents.values():
+        assert entry.filler is sfs.alpha_num.filler
+
+
+def test_reopen(sfs, monkeypatch):
+    first = sfs.open('/ones/5B')
+    assert first.read(3) == '111'
+    # Reopening reuses the resolved parent folder and resets the file
+    monkeypatch.setattr(sfs, '_get_dir_entry', None)
+    second = sfs.open('/ones/5B')
+    assert second is first
+    assert second.read(5) == '11111'
+
+
+def test_open_cache_bounded(sfs):
+    for size in range(OPEN_CACHE_SIZE + 10):
+        sfs.open('/ones/%dB' % size)
+    info = sfs._resolve_open_path.cache_info()
+    assert info.currsize == OPEN_CACHE_SIZE
+    # Equivalent spellings of a path open the same file
+    assert sfs.open('/ones//5B') is sfs.open('/ones/5B')
+
+
 def test_contents(sfs):
     # Contents Test
     assert sfs.open('/zeros/5B').read(5) == '00000'
     assert sfs.open('/ones/5B').read(5) == '11111'
-    for ch in sfs.open('/alpha_num/5B').read(5):
-        assert ch in SizeFSAlphaNumGen.CHARS
+    contents = sfs.open('/alpha_num/128K', 'rb').read()
+    assert len(contents) == 128000
+    assert not contents.translate(None, SizeFSAlphaNumGen.CHARS)
 
 
 def test_length(sfs):
@@ -235,6 +284,8 @@ def test_length(sfs):
     assert len(sfs.open('/zeros/128K').read(k128-1)) == k128 - 1
     assert len(sfs.open('/alpha_num/128K').read(k128)) == k128
     assert len(sfs.open('/zeros/128K+1B').read(k128+1)) == k128+1
+    assert sfs.open('/zeros/1K+1K').length == 2000
+    assert sfs.open('/zeros/1.5K').length == 1500
     assert len(sfs.open('/zeros/128K').read(k256)) == k128
     assert len(sfs.open('/zeros/5B').read(5)) == 5
     assert len(sfs.open('/ones/5B').read(5)) == 5
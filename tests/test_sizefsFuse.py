@@ -1,88 +1,260 @@
-import mock
+from errno import ENODATA, ENOENT, EPERM
+from unittest import mock
+
+import logging
+import os
 import pytest
 
-from fuse import FuseOSError
+from fuse import FuseOSError, LoggingMixIn
 
 from sizefs.contents import SizeFSOneGen
-from sizefs.sizefsFuse import SizefsFuse
+from sizefs.sizefsFuse import (
+    SizefsFuse, FileRecord, _split, _join, _xattr_name
+)
 import sizefs
 
+FOLDER_ATTR_KEYS = frozenset([
+    'st_atime', 'st_ctime', 'st_mtime', 'st_mode', 'st_nlink'
+])
+FILE_ATTR_KEYS = FOLDER_ATTR_KEYS | {'st_size'}
+
 
 @pytest.fixture
 def sfs_fuse():
     return SizefsFuse()
 
 
-def test_sfs_fuse(sfs_fuse):
-    test_contents = 'tests'
+@pytest.fixture
+def file_10b(sfs_fuse):
+    sfs_fuse.create('/10B', 'mode')
+    return '/10B'
+
 
-    sfs_fuse.mkdir('/regex1', None)
+def test_split_and_join():
+    for path in ['/', '/10B', '/zeros', '/zeros/4M', '/dir/', 'dir/', 'path']:
+        assert _split(path) == os.path.split(path)
+    for folder, name in [('/', '10B'), ('/zeros', '4M'), ('/dir/', '1B')]:
+        assert _join(folder, name) == os.path.join(folder, name)
 
+
+@pytest.fixture
+def regex_folder(sfs_fuse):
+    sfs_fuse.mkdir('/regex1', None)
     sfs_fuse.setxattr('/regex1', 'generator', 'regex', None)
-    sfs_fuse.setxattr('/regex1', 'filler', test_contents, None)
+    sfs_fuse.setxattr('/regex1', 'filler', 'tests', None)
+    return '/regex1'
 
+
+def test_sfs_fuse(sfs_fuse, regex_folder):
     # Test multiple reads
-    assert test_contents == sfs_fuse.read('/regex1/5B', 5, 0, None)
-    assert test_contents == sfs_fuse.read('/regex1/5B', 5, 0, None)
+    assert b'tests' == sfs_fuse.read('/regex1/5B', 5, 0, None)
+    assert b'tests' == sfs_fuse.read('/regex1/5B', 5, 0, None)
+
 
+def test_sfs_fuse_regex_override(sfs_fuse, regex_folder):
     # Test simple regex
+    sfs_fuse.create('/regex1/5B', 'mode')
     sfs_fuse.setxattr('/regex1/5B', 'filler', 'a{2}b{2}c', None)
-    assert 'aabbc' == sfs_fuse.read('/regex1/5B', 5, 0, None)
+    assert b'aabbc' == sfs_fuse.read('/regex1/5B', 5, 0, None)
+    assert b'tests' == sfs_fuse.read('/regex1/10B', 5, 0, None)
+
+
+@pytest.mark.parametrize('max_random', ['0', '-5'])
+def test_sfs_fuse_max_random_below_one(sfs_fuse, regex_folder, max_random):
+    sfs_fuse.setxattr('/regex1', 'filler', 'a+b', None)
+    sfs_fuse.setxattr('/regex1', 'max_random', max_random, None)
+    assert sfs_fuse.read('/regex1/10B', 10, 0, None) == b'ababababab'
+
+
+def test_sfs_fuse_max_random_not_a_number(sfs_fuse, regex_folder):
+    sfs_fuse.setxattr('/regex1', 'filler', 'a{3}', None)
+    sfs_fuse.setxattr('/regex1', 'max_random', 'lots', None)
+    assert sfs_fuse.read('/regex1/5B', 5, 0, None) == b'aaa00'
 
 
 def test_sfs_fuse_create(sfs_fuse):
     sfs_fuse.create('/10B', 'mode')
     assert '/10B' in sfs_fuse.files
-    assert sfs_fuse.files['/10B']['attrs']['st_mode']
-    assert sfs_fuse.files['/10B']['attrs']['st_nlink']
-    assert sfs_fuse.files['/10B']['attrs']['st_size'] == 10
-    assert sfs_fuse.files['/10B']['attrs']['st_ctime']
-    assert sfs_fuse.files['/10B']['attrs']['st_mtime']
-    assert sfs_fuse.files['/10B']['attrs']['st_atime']
-    assert type(sfs_fuse.files['/10B']['generator']) == SizeFSOneGen
+    assert sfs_fuse.files['/10B'].attrs['st_mode']
+    assert sfs_fuse.files['/10B'].attrs['st_nlink']
+    assert sfs_fuse.files['/10B'].attrs['st_size'] == 10
+    assert sfs_fuse.files['/10B'].attrs['st_ctime']
+    assert sfs_fuse.files['/10B'].attrs['st_mtime']
+    assert sfs_fuse.files['/10B'].attrs['st_atime']
+    # The generator waits for the first read
+    assert sfs_fuse.files['/10B'].generator is None
+    sfs_fuse.read('/10B', 1, 0, None)
+    assert type(sfs_fuse.files['/10B'].generator) == SizeFSOneGen
+
+
+def test_sfs_fuse_file_sizes(sfs_fuse):
+    sizes = {'4M': 4000000, '4M+1B': 4000001, '4M-1B': 3999999,
+             '1.5K': 1500, '1K+1K': 2000, '1B-2B': 0,
+             '1.1E': 1100000000000000000, '0.5B': 0, '1.5G-1K': 1499999000}
+    for name, size in sizes.items():
+        assert sfs_fuse.getattr('/ones/' + name)['st_size'] == size
+
+
+def test_xattr_name():
+    assert _xattr_name('filler') == 'user.filler'
+    assert _xattr_name('user.filler') == 'user.filler'
+    assert _xattr_name('com.apple.FinderInfo') == 'com.apple.FinderInfo'
+
+
+def test_sfs_fuse_hot_paths_skip_split(sfs_fuse, monkeypatch):
+    sfs_fuse.read('/zeros/4M', 1, 0, None)
+    monkeypatch.setattr(sizefs.sizefsFuse, '_split', None)
+    # Known files and folders are answered without splitting their paths
+    assert sfs_fuse.getattr('/zeros/4M')['st_size'] == 4000000
+    assert sfs_fuse.getattr('/zeros')
+    assert sfs_fuse.read('/zeros/4M', 4, 0, None) == b'0000'
+
+
+def test_file_record():
+    attrs = {'st_size': 10}
+    record = FileRecord(attrs, SizeFSOneGen())
+    assert record.attrs is attrs
+    assert record.read(0, 1) == b'11'
+    record.generator = None
+    assert record.read is None
+    # Records are slotted, there's one per file
+    assert not hasattr(record, '__dict__')
+    with pytest.raises(AttributeError):
+        record.kind = 'ones'
+
+
+def test_sfs_fuse_default_file_attrs(sfs_fuse):
+    assert sfs_fuse.default_file_sizes == [
+        ('100K', 100000), ('4M', 4000000), ('4M-1B', 3999999),
+        ('4M+1B', 4000001)]
+    for folder in ['/zeros', '/ones', '/alpha_num']:
+        for name, size in sfs_fuse.default_file_sizes:
+            attrs = sfs_fuse.getattr(folder + '/' + name)
+            assert attrs['st_size'] == size
+            assert attrs['st_ctime'] == attrs['st_mtime'] == attrs['st_atime']
+    # Each file gets its own attrs dict
+    assert (sfs_fuse.getattr('/zeros/4M') is not
+            sfs_fuse.getattr('/ones/4M'))
+    # A folder's default files are all created at the same moment
+    assert len(set(sfs_fuse.getattr('/zeros/' + name)['st_ctime']
+                   for name in sfs_fuse.default_files)) == 1
+    sfs_fuse.mkdir('/dir1', 'mode')
+    attrs = sfs_fuse.getattr('/dir1')
+    assert attrs['st_ctime'] == attrs['st_mtime'] == attrs['st_atime']
 
 
-def test_sfs_fuse_get_attrs_file(sfs_fuse):
-    sfs_fuse.create('/10B', 'mode')
-    assert set(sfs_fuse.getattr('/10B').keys()) == set([
-        'st_atime', 'st_ctime', 'st_mtime', 'st_size', 'st_mode', 'st_nlink'
-    ])
+def test_sfs_fuse_file_mtime_is_per_file(sfs_fuse, monkeypatch):
+    # setxattr updates a file's mtime in place, which must not reach the
+    # other files created with the same size at the same moment
+    sfs_fuse.mkdir('/dir1', 'mode')
+    sfs_fuse.create('/dir1/5B', 'mode')
+    sfs_fuse.create('/dir1/5B+0B', 'mode')
+    before = sfs_fuse.getattr('/zeros/4M')['st_mtime']
+    monkeypatch.setattr('sizefs.sizefsFuse.time', lambda: before + 60)
+    sfs_fuse.setxattr('/ones/4M', 'generator', 'zeros', None)
+    sfs_fuse.setxattr('/dir1/5B', 'generator', 'zeros', None)
+    assert sfs_fuse.getattr('/ones/4M')['st_mtime'] == before + 60
+    assert sfs_fuse.getattr('/zeros/4M')['st_mtime'] == before
+    assert (sfs_fuse.getattr('/dir1/5B+0B')['st_mtime'] !=
+            sfs_fuse.getattr('/dir1/5B')['st_mtime'])
+
+
+def test_sfs_fuse_default_files_skip_create(monkeypatch):
+    create = mock.Mock()
+    monkeypatch.setattr(SizefsFuse, 'create', create)
+    monkeypatch.setattr(SizefsFuse, '_create_generator', mock.Mock())
+    sfs_fuse = SizefsFuse()
+    assert not create.called
+    assert not sfs_fuse._create_generator.called
+    assert len(sfs_fuse.files) == 3 * len(SizefsFuse.default_files)
+    for path in sfs_fuse.files:
+        assert sfs_fuse.xattrs[path] == {}
+
+
+def test_sfs_fuse_setxattr_rebuilds_generator_lazily(sfs_fuse):
+    sfs_fuse.mkdir('/regex1', None)
+    sfs_fuse.create('/regex1/5B', 'mode')
+    sfs_fuse.setxattr('/regex1', 'generator', 'regex', None)
+    sfs_fuse.setxattr('/regex1', 'filler', 'ab', None)
+    assert sfs_fuse.files['/regex1/5B'].generator is None
+    assert sfs_fuse.files['/regex1/5B'].read is None
+    assert sfs_fuse.read('/regex1/5B', 5, 0, None) == b'abab0'
+    generator = sfs_fuse.files['/regex1/5B'].generator
+    assert sfs_fuse.files['/regex1/5B'].read == generator.read
+    sfs_fuse.setxattr('/regex1', 'comment', 'unrelated', None)
+    assert sfs_fuse.files['/regex1/5B'].generator is generator
+
+
+def test_sfs_fuse_simple_generators_are_shared(sfs_fuse):
+    sfs_fuse.read('/zeros/4M', 10, 0, None)
+    sfs_fuse.read('/zeros/100K', 10, 0, None)
+    sfs_fuse.read('/ones/4M', 10, 0, None)
+    assert (sfs_fuse.files['/zeros/4M'].generator is
+            sfs_fuse.files['/zeros/100K'].generator is SizefsFuse.zero_gen)
+    assert sfs_fuse.files['/ones/4M'].generator is SizefsFuse.one_gen
+    sfs_fuse.read('/alpha_num/4M', 10, 0, None)
+    assert (sfs_fuse.files['/alpha_num/4M'].generator is
+            SizefsFuse.alpha_num_gen)
+
+
+def test_sfs_fuse_file_setxattrs_rebuild_once(sfs_fuse, monkeypatch):
+    sfs_fuse.mkdir('/regex1', None)
+    sfs_fuse.create('/regex1/5B', 'mode')
+    create_generator = mock.Mock(wraps=sfs_fuse._create_generator)
+    monkeypatch.setattr(sfs_fuse, '_create_generator', create_generator)
+    for (name, value) in [('generator', 'regex'), ('filler', 'ab'),
+                          ('padder', 'c'), ('suffix', 'd')]:
+        sfs_fuse.setxattr('/regex1/5B', name, value, None)
+    sfs_fuse.removexattr('/regex1/5B', 'suffix')
+    assert sfs_fuse.files['/regex1/5B'].generator is None
+    assert create_generator.call_count == 0
+    assert sfs_fuse.read('/regex1/5B', 5, 0, None) == b'ababc'
+    assert sfs_fuse.read('/regex1/5B', 5, 0, None) == b'ababc'
+    assert create_generator.call_count == 1
+
+
+def test_sfs_fuse_unknown_generator(sfs_fuse, caplog):
+    sfs_fuse.mkdir('/dir1', None)
+    sfs_fuse.setxattr('/dir1', 'generator', 'bogus', None)
+    assert sfs_fuse.read('/dir1/5B', 5, 0, None) == b'11111'
+    assert 'Unknown generator bogus for /dir1/5B' in caplog.text
+    assert sfs_fuse.getxattr('/dir1/5B', 'generator') == 'ones'
+
+
+def test_sfs_fuse_get_attrs_file(sfs_fuse, file_10b):
+    assert set(sfs_fuse.getattr('/10B').keys()) == FILE_ATTR_KEYS
 
 
 def test_sfs_fuse_get_attrs_folder(sfs_fuse):
-    sfs_fuse.create('/10B', 'mode')
-    assert set(sfs_fuse.getattr('/').keys()) == set([
-        'st_atime', 'st_ctime', 'st_mtime', 'st_mode', 'st_nlink'
-    ])
+    assert set(sfs_fuse.getattr('/').keys()) == FOLDER_ATTR_KEYS
 
 
 def test_sfs_fuse_get_attrs_current_folder(sfs_fuse):
-    sfs_fuse.create('/10B', 'mode')
-    assert set(sfs_fuse.getattr('/.').keys()) == set([
-        'st_atime', 'st_ctime', 'st_mtime', 'st_mode', 'st_nlink'
-    ])
+    assert set(sfs_fuse.getattr('/.').keys()) == FOLDER_ATTR_KEYS
 
 
 def test_sfs_fuse_get_attrs_prev_folder(sfs_fuse):
     sfs_fuse.create('/zeros/10B', 'mode')
-    assert set(sfs_fuse.getattr('/zeros/..').keys()) == set([
-        'st_atime', 'st_ctime', 'st_mtime', 'st_mode', 'st_nlink'
-    ])
-
+    assert set(sfs_fuse.getattr('/zeros/..').keys()) == FOLDER_ATTR_KEYS
 
-def test_sfs_fuse_get_attrs_errors(sfs_fuse):
-    with pytest.raises(FuseOSError):
-        sfs_fuse.getattr('/xxx')
 
+@pytest.mark.parametrize('path', [
+    '/xxx', '/zeros/xxx/.', '/zeros/xxx/yyy/..'])
+def test_sfs_fuse_get_attrs_errors(sfs_fuse, path):
+    with pytest.raises(FuseOSError) as e:
+        sfs_fuse.getattr(path)
+    assert e.value.errno == ENOENT
 
-def test_sfs_fuse_get_attrs_errors_current_dir(sfs_fuse):
-    with pytest.raises(FuseOSError):
-        sfs_fuse.getattr('/zeros/xxx/.')
 
-
-def test_sfs_fuse_get_attrs_errors_prev_dir(sfs_fuse):
-    with pytest.raises(FuseOSError):
-        sfs_fuse.getattr('/zeros/xxx/yyy/..')
+def test_sfs_fuse_get_attrs_creates_valid_files_only(sfs_fuse):
+    files = dict(sfs_fuse.files)
+    for path in ('/zeros/bogus', '/nonexistent/5B', '/5B'):
+        with pytest.raises(FuseOSError) as e:
+            sfs_fuse.getattr(path)
+        assert e.value.errno == ENOENT
+    assert sfs_fuse.files == files
+    assert sfs_fuse.getattr('/zeros/5B')['st_size'] == 5
+    assert '5B' in sfs_fuse.children['/zeros']
 
 
 def test_sfs_fuse_get_attrs_trailing_slash(sfs_fuse, monkeypatch):
@@ -106,8 +278,8 @@ def test_sfs_fuse_get_xattrs(sfs_fuse):
         }
     }
 
-    assert sfs_fuse.getxattr('path', 'attr1') is 'value1'
-    assert sfs_fuse.getxattr('path', 'user.attr2') is 'value2'
+    assert sfs_fuse.getxattr('path', 'attr1') == 'value1'
+    assert sfs_fuse.getxattr('path', 'user.attr2') == 'value2'
 
 
 def test_sfs_fuse_list_xattrs(sfs_fuse):
@@ -119,13 +291,69 @@ def test_sfs_fuse_list_xattrs(sfs_fuse):
         }
     }
 
-    assert set(sfs_fuse.listxattr('path')) == set(['attr1', 'user.attr2'])
+    assert set(sfs_fuse.listxattr('path')) == set([
+        'xxxx.attr1', 'user.attr2'
+    ])
+    assert sfs_fuse.listxattr('/no/such/path') == []
+
+
+def test_sfs_fuse_inherited_xattrs(sfs_fuse):
+    sfs_fuse.mkdir('/dir', 'mode')
+    sfs_fuse.create('/dir/10B', 'mode')
+    sfs_fuse.setxattr('/dir', 'filler', 'a', None)
+    assert sfs_fuse.xattrs['/dir/10B'] == {}
+    assert sfs_fuse.getxattr('/dir/10B', 'filler') == 'a'
+    assert set(sfs_fuse.listxattr('/dir/10B')) == set([
+        'user.generator', 'user.filler'
+    ])
+    # Names are listed with their namespace, as the kernel expects, and
+    # each one can be read back as listed
+    for name in sfs_fuse.listxattr('/dir/10B'):
+        assert name.startswith('user.')
+        assert sfs_fuse.getxattr('/dir/10B', name)
+    # Callers get their own list, changing it leaves the xattrs alone
+    sfs_fuse.listxattr('/dir/10B').append('user.extra')
+    sfs_fuse.listxattr('/dir').clear()
+    assert set(sfs_fuse.listxattr('/dir/10B')) == set([
+        'user.generator', 'user.filler'
+    ])
+
+    # A file's own value wins over the folder's, until it is removed
+    sfs_fuse.setxattr('/dir/10B', 'filler', 'b', None)
+    sfs_fuse.setxattr('/dir', 'filler', 'c', None)
+    assert sfs_fuse.getxattr('/dir/10B', 'filler') == 'b'
+    sfs_fuse.removexattr('/dir/10B', 'filler')
+    assert sfs_fuse.getxattr('/dir/10B', 'filler') == 'c'
+
+
+def test_sfs_fuse_remove_inherited_xattr(sfs_fuse):
+    sfs_fuse.mkdir('/dir', 'mode')
+    sfs_fuse.create('/dir/10B', 'mode')
+    sfs_fuse.setxattr('/dir', 'filler', 'a', None)
+    # Anything listed can be removed, an inherited name only for the file
+    for name in sfs_fuse.listxattr('/dir/10B'):
+        sfs_fuse.removexattr('/dir/10B', name)
+    assert sfs_fuse.listxattr('/dir/10B') == []
+    with pytest.raises(FuseOSError) as error:
+        sfs_fuse.getxattr('/dir/10B', 'filler')
+    assert error.value.errno == ENODATA
+    with pytest.raises(FuseOSError) as error:
+        sfs_fuse.removexattr('/dir/10B', 'filler')
+    assert error.value.errno == ENODATA
+    assert set(sfs_fuse.listxattr('/dir')) == set([
+        'user.generator', 'user.filler'
+    ])
+    # Changes to the folder stay masked, until the file sets its own value
+    sfs_fuse.setxattr('/dir', 'filler', 'b', None)
+    assert 'user.filler' not in sfs_fuse.listxattr('/dir/10B')
+    sfs_fuse.setxattr('/dir/10B', 'filler', 'c', None)
+    assert sfs_fuse.getxattr('/dir/10B', 'filler') == 'c'
 
 
 def test_sfs_fuse_get_xattrs_apple(sfs_fuse):
     sfs_fuse.xattrs = {'path': {}}
     with pytest.raises(FuseOSError):
-        assert sfs_fuse.getxattr('path', 'com.apple.attr1') is 'value1'
+        assert sfs_fuse.getxattr('path', 'com.apple.attr1') == 'value1'
 
 
 def test_sfs_fuse_get_xattrs_errors(sfs_fuse):
@@ -149,6 +377,26 @@ def test_sfs_fuse_not_implemented(sfs_fuse):
         sfs_fuse.chmod('', '')
     with pytest.raises(FuseOSError):
         sfs_fuse.chown('', '', '')
+    with pytest.raises(FuseOSError):
+        sfs_fuse.readlink('/zeros/4M')
+
+
+def test_sfs_fuse_readlink_missing_path(sfs_fuse):
+    files, folders = set(sfs_fuse.files), set(sfs_fuse.folders)
+    xattrs = set(sfs_fuse.xattrs)
+    # Looking up a link that isn't there fails every time, without leaving
+    # an entry behind for the path
+    for _ in range(2):
+        with pytest.raises(FuseOSError) as excinfo:
+            sfs_fuse.readlink('/zeros/link')
+        assert excinfo.value.errno == ENOENT
+    assert 'link' not in sfs_fuse.readdir('/zeros', None)
+    with pytest.raises(FuseOSError) as excinfo:
+        sfs_fuse.getattr('/zeros/link')
+    assert excinfo.value.errno == ENOENT
+    assert set(sfs_fuse.files) == files
+    assert set(sfs_fuse.folders) == folders
+    assert set(sfs_fuse.xattrs) == xattrs
 
 
 def test_sfs_fuse_open_bad_file(sfs_fuse):
@@ -156,24 +404,65 @@ def test_sfs_fuse_open_bad_file(sfs_fuse):
         sfs_fuse.open('/XXXX_BAD_FILE', '')
 
 
-def test_sfs_fuse_open_file(sfs_fuse):
-    sfs_fuse.create('/10B', 'mode')
+def test_sfs_fuse_open_file(sfs_fuse, file_10b):
     current_fd = sfs_fuse.fd
     assert sfs_fuse.open('/10B', '') == current_fd + 1
 
 
-def test_sfs_fuse_read(sfs_fuse):
-    sfs_fuse.create('/10B', 'mode')
-    assert sfs_fuse.read('/10B', 10, 0, None) == '1' * 10
-    assert sfs_fuse.read('/10B', 10, 10, None) == ''
+def test_sfs_fuse_read(sfs_fuse, file_10b):
+    assert sfs_fuse.read('/10B', 10, 0, None) == b'1' * 10
+    assert sfs_fuse.read('/10B', 10, 10, None) == b''
+    # Reads are clipped to the end of the file
+    assert sfs_fuse.read('/10B', 4, 8, None) == b'11'
+    assert sfs_fuse.read('/10B', 1, 9, None) == b'1'
+    assert sfs_fuse.read('/10B', 0, 0, None) == b''
+    assert sfs_fuse.read('/10B', 10, 20, None) == b''
+    sfs_fuse.create('/0B', 'mode')
+    assert sfs_fuse.read('/0B', 10, 0, None) == b''
+
+
+def test_sfs_fuse_default_files(sfs_fuse):
+    assert sfs_fuse.files['/zeros/4M-1B'].generator is None
+    assert sfs_fuse.getattr('/zeros/4M-1B')['st_size'] == 3999999
+    assert sfs_fuse.read('/zeros/4M-1B', 4, 0, None) == b'0000'
+    assert sfs_fuse.files['/zeros/4M-1B'].generator is not None
+
+
+def test_sfs_fuse_read_alpha_num(sfs_fuse):
+    content = sfs_fuse.read('/alpha_num/100K', 100000, 0, None)
+    assert len(content) == 100000
+    assert content.isalnum()
+    assert len(set(content)) > 1
+
+
+def test_sfs_fuse_read_returns_bytes(sfs_fuse):
+    # fusepy copies the result out with ctypes.memmove, which only takes
+    # bytes, not memoryviews of a shared buffer
+    sfs_fuse.mkdir('/regex1', None)
+    sfs_fuse.setxattr('/regex1', 'generator', 'regex', None)
+    sfs_fuse.setxattr('/regex1', 'filler', 'a[bc]d', None)
+    for path in ('/zeros/4M', '/ones/4M', '/alpha_num/4M', '/regex1/4M'):
+        for offset in (0, 3, 1000000):
+            assert type(sfs_fuse.read(path, 4096, offset, None)) is bytes
+
+
+def test_sfs_fuse_read_chunks(sfs_fuse):
+    sfs_fuse.mkdir('/regex1', None)
+    sfs_fuse.setxattr('/regex1', 'generator', 'regex', None)
+    sfs_fuse.setxattr('/regex1', 'filler', 'abc', None)
+    for path in ('/regex1/10B', '/alpha_num/10B'):
+        chunks = [sfs_fuse.read(path, 4, offset, None)
+                  for offset in (0, 4, 8)]
+        assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+        assert b''.join(chunks) == sfs_fuse.read(path, 10, 0, None)
 
 
 def test_sfs_fuse_readdir_root(sfs_fuse):
     sfs_fuse.create('/10B', 'mode')
     sfs_fuse.create('/20B', 'mode')
-    assert set(sfs_fuse.readdir('/', None)) == set([
-        '.', '..', 'zeros', 'ones', 'alpha_num', '10B', '20B'
-    ])
+    assert sorted(sfs_fuse.readdir('/', None)) == [
+        '.', '..', '10B', '20B', 'alpha_num', 'ones', 'zeros'
+    ]
 
 
 def test_sfs_fuse_readdir_folder(sfs_fuse):
@@ -181,9 +470,23 @@ def test_sfs_fuse_readdir_folder(sfs_fuse):
     sfs_fuse.create('/dir/10B', 'mode')
     sfs_fuse.create('/dir/20B', 'mode')
 
-    assert set(sfs_fuse.readdir('/dir', None)) == set([
+    assert sorted(sfs_fuse.readdir('/dir', None)) == [
         '.', '..', '10B', '20B'
-    ])
+    ]
+
+
+def test_sfs_fuse_readdir_similar_folders(sfs_fuse):
+    sfs_fuse.mkdir('/dir', 'mode')
+    sfs_fuse.mkdir('/dir2', 'mode')
+    sfs_fuse.create('/dir2/10B', 'mode')
+
+    assert sfs_fuse.readdir('/dir', None) == ['.', '..']
+    for path in ['/di', '/dir2/10B', '/nodir']:
+        with pytest.raises(FuseOSError) as excinfo:
+            sfs_fuse.readdir(path, None)
+        assert excinfo.value.errno == ENOENT
+    sfs_fuse.setxattr('/dir', 'filler', 'a', None)
+    assert 'user.filler' not in sfs_fuse.xattrs['/dir2/10B']
 
 
 def test_sfs_fuse_removexattr(sfs_fuse):
@@ -214,12 +517,11 @@ def test_sfs_fuse_removexattr_non_existant(sfs_fuse):
         sfs_fuse.removexattr('path', 'attrX')
 
 
-def test_sfs_fuse_removexattr_existing_file(sfs_fuse):
-    sfs_fuse.create('/10B', 'mode')
+def test_sfs_fuse_removexattr_existing_file(sfs_fuse, file_10b):
     sfs_fuse.xattrs = {'/10B': {'user.attr': 'value'}}
     sfs_fuse.removexattr('/10B', 'attr')
 
-    assert sfs_fuse.files['/10B']['attrs']['st_size'] == 10
+    assert sfs_fuse.files['/10B'].attrs['st_size'] == 10
 
 
 def test_sfs_fuse_removexattr_existing_folder(sfs_fuse):
@@ -230,13 +532,17 @@ def test_sfs_fuse_removexattr_existing_folder(sfs_fuse):
         '/dir': {'user.attr': 'value'},
         '/dir/10B': {'user.attr': 'value'},
     }
+    generator = sfs_fuse.files['/dir/10B'].generator
     sfs_fuse.removexattr('/dir', 'attr')
 
+    # The file's own value is kept, and user.attr doesn't affect the
+    # content so neither is the generator
     assert sfs_fuse.xattrs == {
         '/dir': {},
-        '/dir/10B': {'user.generator': 'ones'}
+        '/dir/10B': {'user.attr': 'value'}
     }
-    assert sfs_fuse.files['/dir/10B']['attrs']['st_size'] == 10
+    assert sfs_fuse.files['/dir/10B'].generator is generator
+    assert sfs_fuse.files['/dir/10B'].attrs['st_size'] == 10
 
 
 def test_sfs_fuse_rename(sfs_fuse):
@@ -264,8 +570,67 @@ def test_sfs_fuse_rename_with_files(sfs_fuse):
     sfs_fuse.rename('/dir1', '/dir2')
 
     assert sfs_fuse.folders['/dir2']
-    assert type(sfs_fuse.files['/dir2/10B']['generator']) == SizeFSOneGen
+    assert type(sfs_fuse._get_generator('/dir2/10B')) == SizeFSOneGen
     assert '/dir1' not in sfs_fuse.folders
+    assert sorted(sfs_fuse.readdir('/dir2', None)) == ['.', '..', '10B']
+    assert 'dir2' in sfs_fuse.readdir('/', None)
+    assert 'dir1' not in sfs_fuse.readdir('/', None)
+
+    # The renamed files keep their xattrs
+    sfs_fuse.setxattr('/dir2', 'generator', 'zeros', None)
+    assert sfs_fuse.read('/dir2/10B', 10, 0, None) == b'0' * 10
+
+
+def test_sfs_fuse_rename_refused(sfs_fuse):
+    sfs_fuse.mkdir('/dir1', 'mode')
+    sfs_fuse.create('/10B', 'mode')
+    for (old, new) in [('/', '/dir2'), ('/dir1', '/nodir/dir2'),
+                       ('/dir1', '/zeros/dir2'), ('/dir1', '/10B'),
+                       ('/zeros/4M', '/zeros/5M')]:
+        with pytest.raises(FuseOSError) as excinfo:
+            sfs_fuse.rename(old, new)
+        assert excinfo.value.errno == EPERM
+    # Nothing was added along the way
+    assert '/nodir' not in sfs_fuse.children
+    assert set(sfs_fuse.children['/zeros']) == set(
+        SizefsFuse.default_files)
+    assert sfs_fuse.getattr('/10B')['st_size'] == 10
+
+
+def test_sfs_fuse_rename_only_moves_children(sfs_fuse):
+    sfs_fuse.mkdir('/dir1', 'mode')
+    sfs_fuse.mkdir('/dir10', 'mode')
+    sfs_fuse.create('/dir1/1B', 'mode')
+    sfs_fuse.create('/dir10/1B', 'mode')
+    other_files = dict((path, file) for path, file in sfs_fuse.files.items()
+                       if not path.startswith('/dir1/'))
+    sfs_fuse.rename('/dir1', '/dir2')
+
+    assert '/dir2/1B' in sfs_fuse.files
+    assert '/dir1/1B' not in sfs_fuse.files
+    assert '/dir1' not in sfs_fuse.children
+    for path, file in other_files.items():
+        assert sfs_fuse.files[path] is file
+    assert len(sfs_fuse.files) == len(other_files) + 1
+
+
+def test_sfs_fuse_unlink(sfs_fuse):
+    sfs_fuse.unlink('/zeros/4M')
+    assert '4M' not in sfs_fuse.readdir('/zeros', None)
+    assert '/zeros/4M' not in sfs_fuse.xattrs
+    with pytest.raises(FuseOSError) as excinfo:
+        sfs_fuse.unlink('/zeros/4M')
+    assert excinfo.value.errno == ENOENT
+
+
+def test_sfs_fuse_setxattr_resets_only_children(sfs_fuse):
+    for path in ['/zeros/4M', '/zeros/100K', '/ones/4M']:
+        sfs_fuse.read(path, 1, 0, None)
+    sfs_fuse.setxattr('/zeros', 'generator', 'ones', None)
+    assert sfs_fuse.files['/zeros/4M'].generator is None
+    assert sfs_fuse.files['/zeros/100K'].generator is None
+    assert sfs_fuse.files['/ones/4M'].generator is not None
+    assert sfs_fuse.read('/zeros/4M', 1, 0, None) == b'1'
 
 
 def test_sfs_fuse_rmdir(sfs_fuse):
@@ -274,17 +639,35 @@ def test_sfs_fuse_rmdir(sfs_fuse):
     assert '/dir1' not in sfs_fuse.folders
 
 
+def test_sfs_fuse_rmdir_not_empty(sfs_fuse):
+    sfs_fuse.mkdir('/dir1', 'mode')
+    sfs_fuse.create('/dir1/10B', 'mode')
+    with pytest.raises(FuseOSError):
+        sfs_fuse.rmdir('/dir1')
+    sfs_fuse.unlink('/dir1/10B')
+    sfs_fuse.rmdir('/dir1')
+    assert 'dir1' not in sfs_fuse.readdir('/', None)
+
+
 def test_sfs_fuse_rmdir_non_existant(sfs_fuse):
     with pytest.raises(FuseOSError):
         sfs_fuse.rmdir('/dir2')
 
 
-def test_sfs_fuse_mount(monkeypatch):
-    fuse_mock = mock.Mock()
-    monkeypatch.setattr(sizefs.sizefsFuse, 'FUSE', fuse_mock)
-    SizefsFuse.mount('/tmp')
-    SizefsFuse.mount('/tmp', debug=True)
+def test_sfs_fuse_mount():
+    level = logging.getLogger().level
+    try:
+        with mock.patch('sizefs.sizefsFuse.FUSE') as fuse_mock:
+            SizefsFuse.mount('/tmp')
+            SizefsFuse.mount('/tmp', debug=True)
+    finally:
+        # Debug mounts turn on debug logging for the whole process
+        logging.getLogger().setLevel(level)
     assert fuse_mock.mock_calls == [
         mock.call(mock.ANY, '/tmp', foreground=False, nolocalcaches=True),
         mock.call(mock.ANY, '/tmp', foreground=True, nolocalcaches=True)
     ]
+    # Only debug mounts pay for logging every operation
+    (normal, debug) = [args[0] for _, args, _ in fuse_mock.mock_calls]
+    assert not isinstance(normal, LoggingMixIn)
+    assert isinstance(debug, LoggingMixIn)